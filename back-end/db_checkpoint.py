@@ -0,0 +1,52 @@
+import threading
+import json
+
+# Counters of a download, every one is reported even when it stayed 0
+DOWNLOAD_COUNTERS = ['successful', 'already_downloaded', 'unchanged', 'failed', 'retries', 'processed_rows']
+
+class RowCheckpoint:
+    # Which rows of a job's range are done: every row before next_row, plus the rows after it that finished
+    # out of order while earlier ones were still waiting on a slow host or a retry. A row only counts as done
+    # once its result is committed, and the counters are the sum of the done rows only, so a job resumed from
+    # the checkpoint skips exactly those rows and adds the rest to the same counters.
+    # Rows without a position, like the failed rows of a retry task, only move next_row on, it counts them
+    def __init__(self, start_row, next_row=None, done=(), counters=None):
+        self.start_row = start_row
+        self.next_row = start_row if next_row is None else next_row
+        self.done = set(done)
+        self.counters = dict.fromkeys(DOWNLOAD_COUNTERS, 0)
+        self.counters.update(counters or {})
+        self.lock = threading.Lock()
+
+    @classmethod
+    def load(cls, data, start_row):
+        # From the JSON saved with the job, a job that never got a checkpoint starts at start_row
+        if not data:
+            return cls(start_row)
+        data = json.loads(data)
+        return cls(start_row, data['next_row'], data['done'], data['counters'])
+
+    def dumps(self):
+        with self.lock:
+            return json.dumps({'next_row': self.next_row, 'done': sorted(self.done), 'counters': self.counters})
+
+    def results(self):
+        with self.lock:
+            return dict(self.counters)
+
+    def mark(self, row_number, counts):
+        with self.lock:
+            self.done.add(self.next_row if row_number is None else row_number)
+            while self.next_row in self.done:
+                self.done.remove(self.next_row)
+                self.next_row += 1
+            for key, value in counts.items():
+                self.counters[key] = self.counters.get(key, 0) + value
+
+    def is_done(self, row_number):
+        with self.lock:
+            return row_number < self.next_row or row_number in self.done
+
+    def remaining(self, nrows):
+        # Rows left from next_row to the end of the range, None when the range runs to the end of the sheet
+        return nrows - (self.next_row - self.start_row) if nrows else None
@@ -1,15 +1,19 @@
-from sqlalchemy import Column, Integer, String, Float, Boolean, DateTime, Text, Enum, desc, delete, update, inspect, func, and_, asc, desc
+from sqlalchemy import Column, Integer, BigInteger, String, Float, Boolean, DateTime, Text, Enum, Index, desc, delete, update, inspect, func, and_, or_, case, asc, desc, text
 from sqlalchemy.orm import declarative_base, validates
+from sqlalchemy.dialects import mysql, sqlite
 from sqlalchemy.exc import SQLAlchemyError, NoResultFound, IntegrityError
 from werkzeug.security import generate_password_hash, check_password_hash
-from datetime import datetime
+from datetime import datetime, timedelta
 import re
+import json
+import base64
 from sqlalchemy.future import select
 from fastapi import HTTPException
 from sqlalchemy.ext.asyncio import AsyncSession
 from functools import wraps
 from typing import Optional, Dict
 from db_pydantic_classes import Filter
+from db_checkpoint import DOWNLOAD_COUNTERS
 
 def error_handler(func):
     @wraps(func)
@@ -38,6 +42,22 @@ def error_handler_sync(func):
 
 Base = declarative_base()
 
+def encode_cursor(sort_by, sort_order, value, last_id):
+    # Opaque to the client, the sort it was made for is kept so it isn't used with another one
+    data = json.dumps([sort_by, sort_order, value.isoformat() if isinstance(value, datetime) else value, last_id])
+    return base64.urlsafe_b64encode(data.encode()).decode()
+
+def decode_cursor(cursor, sort_by, sort_order, column):
+    try:
+        cursor_sort_by, cursor_sort_order, value, last_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        if value is not None and column is not None and column.type.python_type is datetime:
+            value = datetime.fromisoformat(value)
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    if cursor_sort_by != sort_by or cursor_sort_order != sort_order:
+        raise HTTPException(status_code=400, detail="Cursor was made for another sort, start again without a cursor")
+    return value, last_id
+
 class BaseModel(Base):
     __abstract__ = True
 
@@ -45,7 +65,8 @@ class BaseModel(Base):
         for key, value in kwargs.items():
             if value is None and not self.__table__.c[key].nullable:
                 raise ValueError(f"{key} cannot be null")
-            if isinstance(self.__table__.c[key].type, String) and self.__table__.c[key].type.length is not None and len(value) > self.__table__.c[key].type.length:
+            # Only strings are checked, an empty cell (None) or a number from a sheet is stored as it is
+            if isinstance(value, str) and isinstance(self.__table__.c[key].type, String) and self.__table__.c[key].type.length is not None and len(value) > self.__table__.c[key].type.length:
                 raise SQLAlchemyError(f"{key} must be less than {self.__table__.c[key].type.length} characters")
             setattr(self, key, value)
 
@@ -119,12 +140,16 @@ class BaseModel(Base):
         return result
     
     @classmethod
-    @error_handler
-    async def get_range(cls, session, page, page_size, filters_dict, sort_by: Optional[str] = None, sort_order: Optional[str] = 'asc'):
-        query = select(cls)
+    def filter_query(cls, query, filters_dict):
         if filters_dict:
             for key, value in filters_dict.items():
                 query = query.where(getattr(cls, key) == value['value'])
+        return query
+
+    @classmethod
+    @error_handler
+    async def get_range(cls, session, page, page_size, filters_dict, sort_by: Optional[str] = None, sort_order: Optional[str] = 'asc'):
+        query = cls.filter_query(select(cls), filters_dict)
         if sort_by and sort_by != "null":
             if sort_order == 'asc':
                 query = query.order_by(asc(getattr(cls, sort_by)))
@@ -134,15 +159,68 @@ class BaseModel(Base):
         result = await session.execute(query)
         return result.scalars().all()
     
+    @classmethod
+    @error_handler
+    async def get_keyset(cls, session, page_size, filters_dict, sort_by: Optional[str] = None, sort_order: Optional[str] = 'asc', cursor: Optional[str] = None):
+        # Pages by the last row of the previous page instead of an offset, so a deep page costs the same as the first.
+        # Rows are ordered by the sort column and id, returns the rows and the cursor of the next page or None
+        sort_by = sort_by if sort_by and sort_by != "null" else None
+        descending = sort_order != 'asc'
+        column = getattr(cls, sort_by) if sort_by else None
+        query = cls.filter_query(select(cls), filters_dict)
+        if cursor:
+            query = query.where(cls.after_cursor(column, descending, decode_cursor(cursor, sort_by, sort_order, column)))
+        order = desc if descending else asc
+        query = query.order_by(*([order(column)] if sort_by else []), order(cls.id)).limit(page_size + 1)
+        rows = (await session.execute(query)).scalars().all()
+        if len(rows) <= page_size:
+            return rows, None
+        rows = rows[:page_size]
+        last = rows[-1]
+        return rows, encode_cursor(sort_by, sort_order, getattr(last, sort_by) if sort_by else None, last.id)
+
+    @classmethod
+    def after_cursor(cls, column, descending, key):
+        # Rows after (value, id) in the page order. MySQL and SQLite both sort NULLs first ascending and last descending
+        value, last_id = key
+        after_id = cls.id < last_id if descending else cls.id > last_id
+        if column is None:
+            return after_id
+        if value is None:
+            if descending:
+                return and_(column.is_(None), after_id)
+            return or_(column.is_not(None), and_(column.is_(None), after_id))
+        after_value = or_(column < value if descending else column > value, and_(column == value, after_id))
+        return or_(after_value, column.is_(None)) if descending else after_value
+
     @classmethod
     @error_handler
     async def get_count(cls, session, filters_dict):
-        query = select(func.count(cls.id))
-        if filters_dict:
-            for key, value in filters_dict.items():
-                query = query.where(getattr(cls, key) == value['value'])
+        query = cls.filter_query(select(func.count(cls.id)), filters_dict)
         result = await session.execute(query)
         return result.scalar()
+
+    @classmethod
+    @error_handler
+    async def get_count_estimate(cls, session, filters_dict):
+        # Row count from the DB's statistics instead of a scan, None when the DB has no estimate for the query
+        connection = await session.connection()
+        if connection.dialect.name == 'mysql':
+            if not filters_dict:
+                result = await connection.execute(
+                    text("SELECT TABLE_ROWS FROM information_schema.TABLES WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = :table"),
+                    {'table': cls.__tablename__})
+                return result.scalar()
+            # The optimizer's guess of the rows the filters match
+            compiled = cls.filter_query(select(cls.id), filters_dict).compile(dialect=connection.dialect)
+            # The driver's paramstyle is positional (%s), so the parameters go in the order of the placeholders
+            params = tuple(compiled.params[name] for name in compiled.positiontup) if compiled.positional else compiled.params
+            row = (await connection.exec_driver_sql(f"EXPLAIN {compiled}", params)).mappings().first()
+            return int(row['rows'] * float(row['filtered'] or 100) / 100) if row and row['rows'] is not None else None
+        if not filters_dict:
+            # SQLite keeps no row count, the highest id reads one index entry and only counts deleted rows too
+            return (await session.execute(select(func.max(cls.id)))).scalar() or 0
+        return None
         
 class RunningTask(BaseModel):
     __tablename__ = 'running_tasks'
@@ -161,33 +239,184 @@ class RunningTask(BaseModel):
 
     results = Column(Text, nullable=True)
 
+    # Engine settings and limits the task was started with
+    engine = Column(String(10), nullable=True)
+    concurrency = Column(Integer, nullable=True)
+    max_per_host = Column(Integer, nullable=True)
+    bandwidth_limit = Column(Integer, nullable=True)  # bytes/second over all downloads
+    host_bandwidth_limit = Column(Integer, nullable=True)  # bytes/second per host
+    max_run_time = Column(Integer, nullable=True)  # seconds
+    max_files = Column(Integer, nullable=True)
+    refresh = Column(Boolean, nullable=True)  # re-check completed rows with conditional requests
+    storage = Column(String(10), nullable=True)  # 'name' or 'cas'
+    shards = Column(Integer, nullable=True)  # number of task_jobs the rows are split over
+
+class TaskJob(BaseModel):
+    # Queue of download jobs run by the download workers. A worker claims a job with a lease and keeps
+    # extending it with heartbeats, a job whose lease ran out is claimed again by another worker
+    __tablename__ = 'task_jobs'
+
+    id = Column(Integer, primary_key=True)
+    task_id = Column(String(36), nullable=False, index=True)  # RunningTask the job belongs to
+    status = Column(String(10), nullable=False, default='queued', index=True)  # queued, running, finished, cancelled or failed
+    options = Column(Text, nullable=False)  # JSON with the file, rows and download options
+    shard = Column(Integer, default=0)  # position of the job's row range in the task
+    results = Column(Text, nullable=True)  # JSON counters of this job, summed into RunningTask.results
+    processed_rows = Column(Integer, default=0)
+    checkpoint = Column(Text, nullable=True)  # JSON RowCheckpoint, a job claimed again resumes from it
+    worker_id = Column(String(64), nullable=True)
+    lease_expires = Column(DateTime, nullable=True)
+    heartbeat_at = Column(DateTime, nullable=True)
+    attempts = Column(Integer, default=0)
+    error = Column(Text, nullable=True)
+    created_at = Column(DateTime, default=datetime.now)
+    started_at = Column(DateTime, nullable=True)
+    finished_at = Column(DateTime, nullable=True)
+
+    @classmethod
+    def claimable(cls, now):
+        return or_(cls.status == 'queued', and_(cls.status == 'running', cls.lease_expires < now))
+
+    @classmethod
+    def claim(cls, session, worker_id, lease_seconds, max_attempts):
+        # Claim the oldest queued or abandoned job. The conditional UPDATE is the lock, of two workers
+        # racing for the same job only one changes the row, so this works the same on MySQL and SQLite
+        now = datetime.now()
+        candidates = session.execute(
+            select(cls.id).where(cls.claimable(now), cls.attempts < max_attempts).order_by(cls.id).limit(10)
+        ).scalars().all()
+        for job_id in candidates:
+            result = session.execute(
+                update(cls).where(cls.id == job_id, cls.claimable(now)).values(
+                    status='running', worker_id=worker_id, lease_expires=now + timedelta(seconds=lease_seconds),
+                    heartbeat_at=now, started_at=now, attempts=cls.attempts + 1)
+            )
+            session.commit()
+            if result.rowcount == 1:
+                return session.get(cls, job_id)
+        return None
+
+    @classmethod
+    def heartbeat(cls, session, job_id, worker_id, lease_seconds):
+        # Extend the lease, returns False when the job was cancelled or claimed by another worker
+        now = datetime.now()
+        result = session.execute(
+            update(cls).where(cls.id == job_id, cls.worker_id == worker_id, cls.status == 'running').values(
+                lease_expires=now + timedelta(seconds=lease_seconds), heartbeat_at=now)
+        )
+        session.commit()
+        return result.rowcount == 1
+
+    @classmethod
+    def save_results(cls, session, job_id, results, checkpoint=None):
+        # The counters and the checkpoint they belong to are saved together
+        values = {'results': json.dumps(results), 'processed_rows': results.get('processed_rows', 0)}
+        if checkpoint is not None:
+            values['checkpoint'] = checkpoint
+        session.execute(update(cls).where(cls.id == job_id).values(**values))
+
+    @classmethod
+    def finish(cls, session, job_id, worker_id, status, error=None, results=None, checkpoint=None):
+        # A job cancelled while it ran keeps that status but still gets its counters and checkpoint
+        values = {'status': case((cls.status == 'cancelled', 'cancelled'), else_=status), 'error': error, 'lease_expires': None, 'finished_at': datetime.now()}
+        if results:
+            values.update(results=json.dumps(results), processed_rows=results.get('processed_rows', 0))
+        if checkpoint is not None:
+            values['checkpoint'] = checkpoint
+        result = session.execute(
+            update(cls).where(cls.id == job_id, cls.worker_id == worker_id, cls.status.in_(['running', 'cancelled'])).values(**values)
+        )
+        session.commit()
+        return result.rowcount == 1
+
+    @classmethod
+    def task_results(cls, session, task_id, exclude_id=None):
+        # Counters of a task summed over its jobs
+        query = select(cls.results).where(cls.task_id == task_id, cls.results.is_not(None))
+        if exclude_id is not None:
+            query = query.where(cls.id != exclude_id)
+        totals = dict.fromkeys(DOWNLOAD_COUNTERS, 0)
+        for results in session.execute(query).scalars():
+            for key, value in json.loads(results).items():
+                totals[key] = totals.get(key, 0) + value
+        return totals
+
+    @classmethod
+    def task_statuses(cls, session, task_id):
+        return set(session.execute(select(cls.status).where(cls.task_id == task_id)).scalars())
+
+    @classmethod
+    def requeue(cls, session, task_id):
+        # Queue the failed and cancelled jobs of a task again with fresh attempts, they resume from their
+        # checkpoints. Returns the number of jobs queued, the caller commits
+        result = session.execute(
+            update(cls).where(cls.task_id == task_id, cls.status.in_(['failed', 'cancelled'])).values(
+                status='queued', worker_id=None, lease_expires=None, attempts=0, error=None, finished_at=None)
+        )
+        return result.rowcount
+
+    @classmethod
+    def fail_exhausted(cls, session, max_attempts):
+        # Jobs whose last worker died after max_attempts claims are failed instead of claimed again,
+        # returns the task ids of those jobs
+        now = datetime.now()
+        exhausted = and_(cls.status == 'running', cls.lease_expires < now, cls.attempts >= max_attempts)
+        task_ids = session.execute(select(cls.task_id).where(exhausted)).scalars().all()
+        if task_ids:
+            session.execute(update(cls).where(exhausted).values(status='failed', error='Lease expired too many times', finished_at=now))
+            session.commit()
+        return task_ids
+
         
 class GRIPdf(BaseModel):
     __tablename__ = 'GRIPdfs'
+    # The dashboard's filters with their usual sort, InnoDB and SQLite add the id to every index so keyset
+    # pages of a filtered and sorted /pdfs read straight from the index. db_schema_migrate.py adds them to older databases
+    __table_args__ = (
+        Index('ix_GRIPdfs_status_attempt_date', 'download_status', 'download_attempt_date'),
+        Index('ix_GRIPdfs_country_year', 'country', 'publication_year'),
+        Index('ix_GRIPdfs_region_year', 'region', 'publication_year'),
+        Index('ix_GRIPdfs_sector_year', 'organization_sector', 'publication_year'),
+        Index('ix_GRIPdfs_type_year', 'organization_type', 'publication_year'),
+    )
 
     id = Column(Integer, primary_key=True, nullable=False)
     brnumber = Column(String(50), nullable=False, unique=True)
     title = Column(Text, nullable=True)
     file_name = Column(Text, nullable=True)
     file_folder = Column(Text, nullable=True)
-    publication_year = Column(Text, nullable=True)
-    organization_name = Column(Text, nullable=True)
-    organization_type = Column(Text, nullable=True)
-    organization_sector = Column(Text, nullable=True)
-    country = Column(Text, nullable=True)
-    region = Column(Text, nullable=True)
-
-    download_status = Column(Text, nullable=False)
+    # Bounded so MySQL can index them without a prefix, row_data cuts longer sheet values to fit
+    publication_year = Column(String(10), nullable=True, index=True)
+    organization_name = Column(String(255), nullable=True, index=True)
+    organization_type = Column(String(100), nullable=True)
+    organization_sector = Column(String(100), nullable=True)
+    country = Column(String(100), nullable=True)
+    region = Column(String(100), nullable=True)
+
+    download_status = Column(String(10), nullable=False)  # TRUE or FALSE
     download_message = Column(Text, nullable=True)
-    download_attempt_date = Column(DateTime, default=datetime.now)
+    download_attempt_date = Column(DateTime, default=datetime.now, index=True)
+    download_attempts = Column(Text, nullable=True)  # JSON list of the failed attempts over all runs
 
     pdf_url = Column(Text, nullable=True)
     pdf_backup_url = Column(Text, nullable=True)
+
+    # Validators of the stored file, sent as If-None-Match/If-Modified-Since by refresh runs
+    etag = Column(String(255), nullable=True)
+    last_modified = Column(String(64), nullable=True)
+    content_length = Column(BigInteger, nullable=True)
+    content_hash = Column(String(64), nullable=True)  # sha256 hex digest
+    source_url = Column(Text, nullable=True)  # URL the stored file was downloaded from
+
+    # Results without validators (skipped or failed rows) keep the stored ones, results without failed attempts keep the history
+    KEEP_IF_NULL = ['etag', 'last_modified', 'content_length', 'content_hash', 'source_url', 'download_attempts']
+    # Failed attempts kept per row, the oldest are dropped beyond this
+    MAX_DOWNLOAD_ATTEMPTS = 50
     
     @classmethod
-    @error_handler_sync
-    def process_row(cls, session, row, file_name, file_folder, download_status, download_message=None):
-        data = {
+    def row_data(cls, row, file_name, file_folder, download_status, download_message=None, download_attempts=None,
+                 etag=None, last_modified=None, content_length=None, content_hash=None, source_url=None):
+        return cls.fit({
             'brnumber': row.get('BRnum', ""),
             'title': row.get('Title', ""),
             'file_name': file_name,
@@ -203,10 +432,94 @@ class GRIPdf(BaseModel):
             'download_status': download_status,
             'download_message': download_message,
             'download_attempt_date': datetime.now(),
-        }
-        
+            'download_attempts': download_attempts,
+            'etag': etag,
+            'last_modified': last_modified,
+            'content_length': content_length,
+            'content_hash': content_hash,
+            'source_url': source_url,
+        })
+
+    @classmethod
+    def fit(cls, data):
+        # Cut the values of the bounded columns to their length, MySQL would fail the whole batch on one long value.
+        # The brnumber is the row's key and is left as it is
+        for key, value in data.items():
+            column = cls.__table__.c[key]
+            length = getattr(column.type, 'length', None)
+            if length is not None and not column.unique and isinstance(value, str) and len(value) > length:
+                data[key] = value[:length]
+        return data
+
+    # Columns /pdfs can filter and sort on, each is the leading column of an index
+    QUERY_FIELDS = ['brnumber', 'publication_year', 'organization_name', 'organization_type', 'organization_sector',
+                    'country', 'region', 'download_status', 'download_attempt_date']
+
+    # Sheet headers of the columns row_data fills from a row
+    SHEET_COLUMNS = {
+        'BRnum': 'brnumber', 'Title': 'title', 'Publication Year': 'publication_year', 'Name': 'organization_name',
+        'Organization type': 'organization_type', 'Sector': 'organization_sector', 'Country': 'country',
+        'Region': 'region', 'Pdf_URL': 'pdf_url', 'Report Html Address': 'pdf_backup_url',
+    }
+
+    def sheet_row(self):
+        # The stored row in the shape load_data yields, so it can go through the download pipeline again
+        return {header: getattr(self, column) for header, column in self.SHEET_COLUMNS.items()}
+
+    @classmethod
+    def failed_rows(cls, session, after_id, limit, message_pattern=None, attempted_before=None):
+        # A page of failed rows by id, message_pattern is a LIKE pattern on download_message
+        query = select(cls).where(cls.download_status == 'FALSE', cls.id > after_id)
+        if message_pattern:
+            query = query.where(cls.download_message.like(message_pattern))
+        if attempted_before:
+            query = query.where(cls.download_attempt_date < attempted_before)
+        return session.execute(query.order_by(cls.id).limit(limit)).scalars().all()
+
+    @classmethod
+    @error_handler_sync
+    def process_row(cls, session, row, file_name, file_folder, download_status, download_message=None):
+        data = cls.row_data(row, file_name, file_folder, download_status, download_message)
         pdf = cls.upsert(session, **data)
         return pdf
+
+    @classmethod
+    def merge_attempts(cls, session, rows):
+        # A run saves all the attempts it made on a row so far, they replace what the same run saved before
+        # and go after the attempts of earlier runs, so download_attempts is the row's history over all runs
+        new = {row['brnumber']: row for row in rows if row.get('download_attempts')}
+        if not new:
+            return rows
+        stored = dict(session.execute(
+            select(cls.brnumber, cls.download_attempts).where(cls.brnumber.in_(new), cls.download_attempts.is_not(None))
+        ).all())
+        for brnumber, row in new.items():
+            attempts = json.loads(row['download_attempts'])
+            runs = {attempt.get('run') for attempt in attempts}
+            history = [attempt for attempt in json.loads(stored.get(brnumber) or '[]') if attempt.get('run', '') not in runs]
+            row['download_attempts'] = json.dumps((history + attempts)[-cls.MAX_DOWNLOAD_ATTEMPTS:])
+        return rows
+
+    @classmethod
+    @error_handler_sync
+    def bulk_upsert(cls, session, rows):
+        # Insert or update a batch of row_data dicts keyed on brnumber with one statement and one commit
+        if not rows:
+            return 0
+        cls.merge_attempts(session, rows)
+        def new_value(key, inserted):
+            column = inserted[key]
+            return func.coalesce(column, getattr(cls, key)) if key in cls.KEEP_IF_NULL else column
+
+        if session.get_bind().dialect.name == 'mysql':
+            stmt = mysql.insert(cls).values(rows)
+            stmt = stmt.on_duplicate_key_update({key: new_value(key, stmt.inserted) for key in rows[0] if key != 'brnumber'})
+        else:
+            stmt = sqlite.insert(cls).values(rows)
+            stmt = stmt.on_conflict_do_update(index_elements=['brnumber'], set_={key: new_value(key, stmt.excluded) for key in rows[0] if key != 'brnumber'})
+        session.execute(stmt)
+        session.commit()
+        return len(rows)
     
     @classmethod
     @error_handler
@@ -1,10 +1,43 @@
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy import create_engine
+from sqlalchemy.engine import make_url
 from dotenv import load_dotenv
 import pymysql
 import os
 
+load_dotenv()
+
+# Connection pool of the engines, checked out per request instead of connecting per request
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', 5))
+DB_MAX_OVERFLOW = int(os.getenv('DB_MAX_OVERFLOW', 10))
+DB_POOL_TIMEOUT = float(os.getenv('DB_POOL_TIMEOUT', 30))
+# Seconds before a pooled connection is replaced, below MySQL's wait_timeout so the server never drops one first
+DB_POOL_RECYCLE = int(os.getenv('DB_POOL_RECYCLE', 3600))
+# Test a connection on checkout and replace it when the server closed it
+DB_POOL_PRE_PING = os.getenv('DB_POOL_PRE_PING', 'True') == 'True'
+
+def pool_options(db_url):
+    # SQLite gets the pool SQLAlchemy picks for it, aiosqlite's NullPool takes no size or overflow
+    if make_url(db_url).get_backend_name() == 'sqlite':
+        return {'pool_pre_ping': DB_POOL_PRE_PING}
+    return {
+        'pool_size': DB_POOL_SIZE,
+        'max_overflow': DB_MAX_OVERFLOW,
+        'pool_timeout': DB_POOL_TIMEOUT,
+        'pool_recycle': DB_POOL_RECYCLE,
+        'pool_pre_ping': DB_POOL_PRE_PING,
+    }
+
+def pool_stats(engine):
+    # Counters of an engine's pool, pools that don't keep connections only have a status line
+    pool = engine.pool
+    stats = {'pool': type(pool).__name__, 'status': pool.status()}
+    for name in ('size', 'checkedin', 'checkedout', 'overflow'):
+        if hasattr(pool, name):
+            stats[name] = getattr(pool, name)()
+    return stats
+
 class BaseDatabaseConnect:
     def __init__(self, async_mode, db_url=None):
         self.db_url = db_url if db_url else self.db_url_from_env(async_mode)
@@ -52,6 +85,7 @@ class SyncDatabaseConnect(BaseDatabaseConnect):
             self.db_url,
             #connect_args=connect_args,
             #echo=True
+            **pool_options(self.db_url)
         )
         self.sessionmaker = sessionmaker(self.engine, expire_on_commit=False)
 
@@ -71,9 +105,32 @@ class AsyncDatabaseConnect(BaseDatabaseConnect):
             self.db_url,
             #connect_args=connect_args,
             #echo=True
+            **pool_options(self.db_url)
         )
         self.sessionmaker = sessionmaker(self.engine, expire_on_commit=False, class_=AsyncSession)
 
     async def close(self):
         await self.session.close()
-        await self.engine.dispose()
\ No newline at end of file
+        await self.engine.dispose()
+
+    def new_session(self):
+        return self.sessionmaker()
+
+# Engines shared by the whole API process, opened and disposed by main's lifespan handler
+shared = {}
+
+def open_shared():
+    if not shared:
+        shared['async'] = AsyncDatabaseConnect()
+        shared['sync'] = SyncDatabaseConnect()
+    return shared['async'], shared['sync']
+
+async def close_shared():
+    if shared:
+        await shared.pop('async').engine.dispose()
+        shared.pop('sync').engine.dispose()
+
+def shared_stats():
+    if not shared:
+        return {}
+    return {'async': pool_stats(shared['async'].engine.sync_engine), 'sync': pool_stats(shared['sync'].engine)}
\ No newline at end of file
@@ -0,0 +1,107 @@
+from sqlalchemy import event
+from sqlalchemy.orm import Session, object_session
+from db_classes import GRIPdf
+from collections import OrderedDict
+from dotenv import load_dotenv
+import threading
+import json
+import time
+import os
+
+load_dotenv()
+
+# exact counts the rows (cached), estimate asks the DB's statistics, none skips the total
+COUNT_MODES = ['exact', 'estimate', 'none']
+# Filter sets whose totals are kept
+COUNT_CACHE_SIZE = int(os.getenv('COUNT_CACHE_SIZE', 256))
+# Seconds a total is used, writes from this process drop it right away, this bounds the ones from worker processes
+COUNT_CACHE_TTL = float(os.getenv('COUNT_CACHE_TTL', 30))
+
+class CountCache:
+    # Totals of /pdfs by normalised filter set. Every committed write to GRIPdfs moves the generation on, a total
+    # counted under an older generation is not used any more
+    def __init__(self, max_size=COUNT_CACHE_SIZE, ttl=COUNT_CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.generation = 0
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def key(filters_dict):
+        # The same filters in another order or with a number sent as a string are the same query
+        return json.dumps(sorted((key, str(value['value'])) for key, value in (filters_dict or {}).items()))
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            count, generation, expires = entry
+            if generation != self.generation or expires < time.monotonic():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return count
+
+    def put(self, key, count, generation):
+        # generation is read before counting, a write committed while the count ran makes the entry stale at once
+        with self.lock:
+            if generation != self.generation or self.ttl <= 0:
+                return
+            self.entries[key] = (count, generation, time.monotonic() + self.ttl)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def invalidate(self):
+        with self.lock:
+            self.generation += 1
+            self.entries.clear()
+
+count_cache = CountCache()
+
+async def count_pdfs(session, filters_dict, mode='exact'):
+    # Returns the total and whether it is an estimate. An estimate the DB can't give falls back to the cached count
+    if mode == 'none':
+        return None, False
+    if mode == 'estimate':
+        estimate = await GRIPdf.get_count_estimate(session, filters_dict)
+        if estimate is not None:
+            return estimate, True
+    key = count_cache.key(filters_dict)
+    count = count_cache.get(key)
+    if count is None:
+        generation = count_cache.generation
+        count = await GRIPdf.get_count(session, filters_dict)
+        count_cache.put(key, count, generation)
+    return count, False
+
+# Writes to GRIPdfs move the generation on when their session commits, the batched download writer,
+# upserts and ORM changes all go through these
+WRITE_KEY = 'count_cache_write'
+
+def remember_write(mapper, connection, target):
+    session = object_session(target)
+    if session is None:
+        count_cache.invalidate()
+    else:
+        session.info[WRITE_KEY] = True
+
+for event_name in ('after_insert', 'after_update', 'after_delete'):
+    event.listen(GRIPdf, event_name, remember_write)
+
+@event.listens_for(Session, 'do_orm_execute')
+def remember_bulk_write(orm_execute_state):
+    if (orm_execute_state.is_insert or orm_execute_state.is_update or orm_execute_state.is_delete) \
+            and orm_execute_state.bind_mapper is not None and orm_execute_state.bind_mapper.class_ is GRIPdf:
+        orm_execute_state.session.info[WRITE_KEY] = True
+
+@event.listens_for(Session, 'after_commit')
+def invalidate_committed(session):
+    if session.info.pop(WRITE_KEY, False):
+        count_cache.invalidate()
+
+@event.listens_for(Session, 'after_rollback')
+def forget_writes(session):
+    session.info.pop(WRITE_KEY, None)
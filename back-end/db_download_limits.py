@@ -0,0 +1,147 @@
+import threading
+import asyncio
+import time
+import random
+
+class TokenBucket:
+    # Bytes/second budget shared by every worker, refilled continuously up to one second of burst
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.capacity = burst if burst else rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def reserve(self, amount):
+        # Take the tokens right away and return how long the caller has to wait before they are covered
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= amount
+            return max(0.0, -self.tokens / self.rate)
+
+class BandwidthLimiter:
+    # Aggregate limit over all downloads plus an optional limit per host, both in bytes/second
+    def __init__(self, bandwidth_limit=None, host_bandwidth_limit=None):
+        self.bucket = TokenBucket(bandwidth_limit) if bandwidth_limit else None
+        self.host_bandwidth_limit = host_bandwidth_limit
+        self.host_buckets = {}
+        self.lock = threading.Lock()
+
+    def __bool__(self):
+        return self.bucket is not None or bool(self.host_bandwidth_limit)
+
+    def delay(self, host, amount):
+        delays = [0.0]
+        if self.bucket is not None:
+            delays.append(self.bucket.reserve(amount))
+        if self.host_bandwidth_limit:
+            with self.lock:
+                bucket = self.host_buckets.get(host)
+                if bucket is None:
+                    bucket = self.host_buckets[host] = TokenBucket(self.host_bandwidth_limit)
+            delays.append(bucket.reserve(amount))
+        return max(delays)
+
+    def throttle(self, host, amount):
+        delay = self.delay(host, amount)
+        if delay:
+            time.sleep(delay)
+
+    async def throttle_async(self, host, amount):
+        delay = self.delay(host, amount)
+        if delay:
+            await asyncio.sleep(delay)
+
+class DownloadCancelled(Exception):
+    pass
+
+class CancelToken:
+    # Set when a task is cancelled. No job is handed out after that, transfers stop at their next chunk
+    # and waits for retries return early, so the workers are free again within one read timeout
+    def __init__(self):
+        self.event = threading.Event()
+
+    def cancel(self):
+        self.event.set()
+
+    @property
+    def cancelled(self):
+        return self.event.is_set()
+
+    def check(self):
+        if self.event.is_set():
+            raise DownloadCancelled('Download task was cancelled')
+
+    def wait(self, timeout):
+        # Sleep for timeout seconds unless the task is cancelled first
+        return self.event.wait(timeout)
+
+class RunLimits:
+    # Wall-clock deadline, a cap on successful files and the cancel token, checked before a job is handed out.
+    # A deadline given as a timestamp wins over max_run_time, so every shard and retry of a task stops at the same time
+    def __init__(self, max_run_time=None, max_files=None, cancel_token=None, deadline=None):
+        self.deadline = deadline if deadline else (time.time() + max_run_time if max_run_time else None)
+        self.max_files = max_files
+        self.cancel_token = cancel_token
+
+    def reached(self, counters, in_flight=0):
+        if self.cancel_token is not None and self.cancel_token.cancelled:
+            return True
+        if self.deadline is not None and time.time() >= self.deadline:
+            return True
+        # Jobs in flight may still succeed, so they count against max_files
+        if self.max_files is not None and counters['successful'] + in_flight >= self.max_files:
+            return True
+        return False
+
+# Error classes that come from the network rather than from the row, these are retried and trip the breaker
+TRANSIENT_ERRORS = ['timeout', 'connection', 'server', 'rate_limited']
+
+class RetryPolicy:
+    # Max attempts per URL and base backoff in seconds for each retried error class,
+    # any other class (404, not a PDF, DNS failure...) fails right away
+    POLICIES = {
+        'timeout': {'max_attempts': 3, 'base_delay': 2},
+        'connection': {'max_attempts': 3, 'base_delay': 2},
+        'server': {'max_attempts': 3, 'base_delay': 5},
+        'rate_limited': {'max_attempts': 4, 'base_delay': 10},
+    }
+
+    def __init__(self, policies=None, max_delay=300):
+        self.policies = policies if policies else self.POLICIES
+        self.max_delay = max_delay
+
+    def delay(self, error_class, attempt, retry_after=None):
+        # Seconds to wait before the next attempt, or None when the error should not be retried
+        policy = self.policies.get(error_class)
+        if policy is None or attempt >= policy['max_attempts']:
+            return None
+        # Exponential backoff with jitter, so retries of a burst of failures don't all land at once
+        delay = min(self.max_delay, policy['base_delay'] * 2 ** (attempt - 1))
+        delay = random.uniform(delay / 2, delay)
+        if retry_after is not None:
+            delay = max(delay, min(self.max_delay, retry_after))
+        return delay
+
+class CircuitBreaker:
+    # Counts transient failures in a row per host. At `threshold` the host is paused for `cooldown` seconds,
+    # after which one more failure pauses it again and a success closes the breaker
+    def __init__(self, threshold=5, cooldown=60):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = {}
+        self.lock = threading.Lock()
+
+    def record_success(self, host):
+        with self.lock:
+            self.failures.pop(host, None)
+
+    def record_failure(self, host):
+        # Returns the monotonic time the host is paused until, or None while the breaker is closed
+        with self.lock:
+            self.failures[host] = self.failures.get(host, 0) + 1
+            if self.failures[host] >= self.threshold:
+                return time.monotonic() + self.cooldown
+        return None
@@ -1,20 +1,230 @@
 import os
 from tqdm import tqdm
 import urllib.request
+import urllib.error
 import socket
-from openpyxl import load_workbook
-from concurrent.futures import ThreadPoolExecutor, as_completed
+import asyncio
+import aiohttp
+import threading
+import queue
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from collections import deque
+from urllib.parse import urlsplit
+from datetime import datetime
+import http.client
+import heapq
+import json
+import uuid
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
 from db_classes import GRIPdf
 from db_connect import SyncDatabaseConnect
+from db_download_writer import DownloadResultWriter
+from db_http_connections import KeepAliveHandler
+from db_download_limits import BandwidthLimiter, RunLimits, RetryPolicy, CircuitBreaker, CancelToken, DownloadCancelled, TRANSIENT_ERRORS
+from db_pdf_storage import PdfStorage, IncompleteDownloadError, CHUNK_SIZE
+from db_row_cache import SheetRowCache, CsvOffsetIndex
+from db_checkpoint import RowCheckpoint, DOWNLOAD_COUNTERS
 from pathlib import Path
 import time
-import csv
 
 # Set a default timeout for all socket operations
 socket.setdefaulttimeout(5)
 
+# Global number of in-flight fetches for the asyncio engine
+DEFAULT_ASYNC_CONCURRENCY = int(os.getenv('DOWNLOAD_CONCURRENCY', 500))
+DOWNLOAD_ENGINES = ['thread', 'async']
+# Bytes the asyncio engine collects from a response before handing them to a thread for writing
+ASYNC_WRITE_SIZE = int(os.getenv('DOWNLOAD_ASYNC_WRITE_SIZE', 1024 * 1024))
+
+# Downloads are sniffed for this signature and then streamed to disk in chunks
+PDF_MAGIC = b'%PDF-'
+
+# Max connections to one host at a time, the rest of the slots go to other hosts
+DEFAULT_MAX_PER_HOST = int(os.getenv('DOWNLOAD_MAX_PER_HOST', 6))
+
+# Max rows read ahead of the workers, the scheduler only looks this far for hosts with a free slot
+DEFAULT_QUEUE_SIZE = int(os.getenv('DOWNLOAD_QUEUE_SIZE', 1000))
+
+# Where a task reads its rows: the uploaded sheet, or the failed rows of the GRIPdfs table
+DOWNLOAD_SOURCES = ['sheet', 'failed']
+# running_file of the tasks retrying failed rows, one of them runs at a time like for a sheet
+FAILED_ROWS_FILE = 'GRIPdfs (failed)'
+# Failed rows read from the DB per query
+FAILED_ROWS_BATCH_SIZE = int(os.getenv('FAILED_ROWS_BATCH_SIZE', 1000))
+
+def url_host(url):
+    if not isinstance(url, str):
+        return ''
+    return urlsplit(url).netloc.lower()
+
+def classify_error(error):
+    # Map urllib and aiohttp errors to the error classes of RetryPolicy
+    status = None
+    if isinstance(error, urllib.error.HTTPError):
+        status = error.code
+    elif isinstance(error, aiohttp.ClientResponseError):
+        status = error.status
+    if status is not None:
+        if status == 429:
+            return 'rate_limited'
+        return 'server' if status >= 500 else 'client'
+    if isinstance(error, urllib.error.URLError) and isinstance(error.reason, Exception):
+        error = error.reason
+    if isinstance(error, aiohttp.ClientConnectorError):
+        error = error.os_error
+    if isinstance(error, socket.gaierror):
+        return 'dns'
+    if isinstance(error, (socket.timeout, TimeoutError, asyncio.TimeoutError)):
+        return 'timeout'
+    if isinstance(error, (ConnectionError, http.client.HTTPException, IncompleteDownloadError, urllib.error.URLError, aiohttp.ClientConnectionError, aiohttp.ClientPayloadError)):
+        return 'connection'
+    return 'other'
+
+def retry_after(error):
+    # Seconds from a Retry-After header, the HTTP-date form is ignored
+    headers = getattr(error, 'headers', None)
+    value = headers.get('Retry-After') if headers else None
+    return int(value) if value and value.strip().isdigit() else None
+
+def response_validators(headers, part):
+    # What a later refresh run needs to ask the server whether the file changed
+    return {
+        'etag': headers.get('ETag') if headers else None,
+        'last_modified': headers.get('Last-Modified') if headers else None,
+        'content_length': part.written,
+        'content_hash': part.hash.hexdigest(),
+    }
+
+class DownloadJob:
+    def __init__(self, row, url_header, attempts=None, row_number=None, counts=None):
+        self.row = row
+        self.url_header = url_header
+        self.host = url_host(row.get(url_header))
+        # Failed attempts for the row, shared with the Report Html Address fallback
+        self.attempts = attempts if attempts is not None else []
+        self.error_class = None
+        # Position of the row in the sheet and what it added to the counters, for the checkpoint
+        self.row_number = row_number
+        self.counts = counts if counts is not None else {}
+
+class HostScheduler:
+    # Keeps a queue of jobs per host and hands them out round-robin over the hosts that have a free slot,
+    # so one slow host can hold at most max_per_host workers while the others keep going.
+    # Retries wait in a heap until they are due and hosts can be paused, neither holds a worker
+    def __init__(self, max_per_host):
+        self.max_per_host = max_per_host
+        self.queues = {}
+        self.active = {}
+        self.ready = deque()
+        self.in_ready = set()
+        self.deferred = []
+        self.paused = {}
+        self.pending = 0
+        self.sequence = 0
+
+    def __len__(self):
+        return self.pending
+
+    def mark_ready(self, host):
+        # A host is in the ready ring while it has queued jobs, a free slot and is not paused
+        if host in self.in_ready or host in self.paused or not self.queues.get(host):
+            return
+        if self.active.get(host, 0) < self.max_per_host:
+            self.ready.append(host)
+            self.in_ready.add(host)
+
+    def add(self, job):
+        self.queues.setdefault(job.host, deque()).append(job)
+        self.pending += 1
+        self.mark_ready(job.host)
+
+    def defer(self, job, ready_at):
+        heapq.heappush(self.deferred, (ready_at, self.sequence, job))
+        self.sequence += 1
+        self.pending += 1
+
+    def pause(self, host, until):
+        self.paused[host] = until
+
+    def poll(self):
+        # Queue the retries that are due and resume the hosts whose pause is over
+        now = time.monotonic()
+        while self.deferred and self.deferred[0][0] <= now:
+            job = heapq.heappop(self.deferred)[2]
+            self.pending -= 1
+            self.add(job)
+        for host, until in list(self.paused.items()):
+            if until <= now:
+                del self.paused[host]
+                self.mark_ready(host)
+
+    def wakeup(self):
+        # Seconds until a deferred job or a paused host is due, None when nothing is waiting
+        due = [until for until in self.paused.values()]
+        if self.deferred:
+            due.append(self.deferred[0][0])
+        return max(0.0, min(due) - time.monotonic()) if due else None
+
+    def next(self):
+        self.poll()
+        while self.ready:
+            host = self.ready.popleft()
+            self.in_ready.discard(host)
+            if host in self.paused:
+                # Dropped from the ring until poll resumes it
+                continue
+            jobs = self.queues[host]
+            job = jobs.popleft()
+            self.pending -= 1
+            self.active[host] = self.active.get(host, 0) + 1
+            if not jobs:
+                del self.queues[host]
+            else:
+                # Back of the ring, so the other hosts get their turn first
+                self.mark_ready(host)
+            return job
+        return None
+
+    def release(self, job):
+        host = job.host
+        self.active[host] -= 1
+        if self.active[host] == 0:
+            del self.active[host]
+        self.mark_ready(host)
+
+class DownloadIndex:
+    # What is already downloaded, loaded once per task so the skip checks are set lookups instead of
+    # a DB query and a stat per row. Plain dict/set updates are atomic, so the workers share it without a lock
+    def __init__(self):
+        # brnumber -> (file_folder, file_name) of the completed downloads
+        self.completed = {}
+        # File name -> folder of the files on disk
+        self.files = {}
+        # ETag/Last-Modified of the completed downloads, used by refresh runs
+        self.validators = {}
+        # URL -> (file_folder, file_name) of stored files, used to skip known URLs in content-addressed mode
+        self.sources = {}
+
+    def load(self, SessionLocal, storage):
+        with SessionLocal() as session:
+            query = session.query(GRIPdf.brnumber, GRIPdf.file_folder, GRIPdf.file_name, GRIPdf.etag, GRIPdf.last_modified, GRIPdf.source_url).filter(GRIPdf.download_status == 'TRUE')
+            for brnumber, file_folder, file_name, etag, last_modified, source_url in query.yield_per(10000):
+                self.completed[brnumber] = (file_folder, file_name)
+                if source_url and file_name:
+                    self.sources[source_url] = (file_folder, file_name)
+                if file_name and (etag or last_modified):
+                    self.validators[brnumber] = {'file_folder': file_folder, 'file_name': file_name, 'etag': etag, 'last_modified': last_modified}
+        self.files = {file_name: file_folder for file_folder, file_name in storage.list_files()}
+        return self
+
+    def add(self, brnumber, file_folder, file_name, source_url=None):
+        self.completed[brnumber] = (file_folder, file_name)
+        if file_name:
+            self.files[file_name] = file_folder
+            if source_url:
+                self.sources[source_url] = (file_folder, file_name)
+
 class DownloadManager:
     def __init__(self, folder='pdf-files', file_with_urls='pdf-urls/GRI_2017_2020.xlsx'):
         # Create a folder to store the downloaded files
@@ -32,6 +242,33 @@ class DownloadManager:
         SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
         self.engine = engine
         self.SessionLocal = SessionLocal
+        # Batches the download results while an engine is running
+        self.writer = None
+        # Completed brnumbers and existing filenames, loaded when an engine starts
+        self.index = None
+        # Bandwidth, run time and max files limits, set by start_download
+        self.limiter = BandwidthLimiter()
+        self.run_limits = RunLimits()
+        # Stops a running task, set by start_download
+        self.cancel_token = CancelToken()
+        # Rows of the task that are done, set by start_download
+        self.checkpoint = None
+        # Refresh runs re-check completed rows with conditional requests instead of skipping them
+        self.refresh = False
+        # Where the files are written, by name or by content digest
+        self.storage = PdfStorage(self.folder)
+        # Backoff per error class and a breaker that pauses hosts which keep failing
+        self.retry_policy = RetryPolicy()
+        self.breaker = CircuitBreaker()
+        # Tags the failed attempts of this run, a row's download_attempts keeps those of earlier runs
+        self.run_id = uuid.uuid4().hex[:8]
+        # The thread engine's urllib opener, each worker thread reuses its connection to a host for the next request there
+        self.connections = KeepAliveHandler()
+        self.opener = urllib.request.build_opener(self.connections)
+
+    def load_index(self):
+        self.index = DownloadIndex().load(self.SessionLocal, self.storage)
+        return self.index
 
     def load_data(self, start=0, nrows=None):
         # Get the file extension
@@ -39,25 +276,32 @@ class DownloadManager:
     
         # Load the file
         if file_extension == '.csv':
-            with open(self.file_with_urls, 'r') as f:
-                reader = csv.reader(f)
-                headers = next(reader)
-                for i, row in enumerate(reader):
-                    if i < start:
-                        continue
-                    if nrows is not None and i >= start + nrows:
-                        break
-                    yield dict(zip(headers, row))
+            # Seeks to the nearest indexed record before start instead of parsing every record up to it
+            yield from CsvOffsetIndex(self.file_with_urls).rows(start, nrows)
         elif file_extension in ['.xlsx', '.xlsm', '.xltx', '.xltm']:
-            workbook = load_workbook(filename=self.file_with_urls, read_only=True)
-            worksheet = workbook.active
-            headers = [cell.value for cell in next(worksheet.iter_rows())]
-            for i, row in enumerate(worksheet.iter_rows(min_row=start+2, max_row=start+nrows+1 if nrows else None), start=start):
-                yield dict(zip(headers, (cell.value for cell in row)))
+            # The sheet is parsed once into a row cache keyed by its hash, later tasks seek straight to start
+            yield from SheetRowCache(self.file_with_urls).rows(start, nrows)
         else:
             raise ValueError(f"Unsupported file format: {file_extension}")
+
+    def load_failed(self, nrows=None, message_pattern=None, attempted_before=None):
+        # The failed rows of the GRIPdfs table instead of the sheet, paged by id in short sessions so the writer
+        # can update the rows in between. Retried rows get a new attempt date, so with attempted_before set to
+        # when the task started a resumed task doesn't pick them up a second time
+        after_id = 0
+        while nrows is None or nrows > 0:
+            limit = min(FAILED_ROWS_BATCH_SIZE, nrows) if nrows is not None else FAILED_ROWS_BATCH_SIZE
+            with self.SessionLocal() as session:
+                pdfs = GRIPdf.failed_rows(session, after_id, limit, message_pattern, attempted_before)
+            for pdf in pdfs:
+                yield pdf.sheet_row()
+            if len(pdfs) < limit:
+                return
+            after_id = pdfs[-1].id
+            if nrows is not None:
+                nrows -= len(pdfs)
         
-    def save_download_result(self, row, file_name, download_status, download_message=None, file_folder=None):
+    def save_download_result(self, row, file_name, download_status, download_message=None, file_folder=None, attempts=None, validators=None, source_url=None):
         if file_folder is None:
             file_folder = self.folder
         if download_status == 'FALSE':
@@ -65,21 +309,34 @@ class DownloadManager:
             file_name = ""
         # Convert the file_folder to a string
         file_folder = str(file_folder)
-        # Start a new SQLAlchemy session
+        if download_status == 'TRUE' and self.index is not None:
+            # Keep the index current so later rows see this download
+            self.index.add(row.get('BRnum', ""), file_folder, file_name, source_url)
+        data = GRIPdf.row_data(
+            row=row,
+            file_name=file_name,
+            file_folder=file_folder,
+            download_status=download_status,
+            download_message=download_message,
+            download_attempts=json.dumps(attempts) if attempts else None,
+            source_url=source_url,
+            **(validators or {}),
+        )
+        if self.writer is not None:
+            # Hand the result to the batched writer
+            self.writer.put(data)
+            return
+        # Start a new SQLAlchemy session, stored validators are only replaced by new ones
         with self.SessionLocal() as session:
-            # Use the create_pdf_sync method to create a new GRIPdf object
-            GRIPdf.process_row(
-                session=session,
-                row=row,
-                file_name=file_name,
-                file_folder=file_folder,
-                download_status=download_status,
-                download_message=download_message,
-            )
-            
-    def download_file(self, row, url_header):
+            GRIPdf.merge_attempts(session, [data])
+            GRIPdf.upsert(session, **{key: value for key, value in data.items() if value is not None or key not in GRIPdf.KEEP_IF_NULL})
+
+    def download_file(self, row, url_header, job=None):
+        job = job if job is not None else DownloadJob(row, url_header)
         url = row[url_header]
-        brnumber = row['BRnum']
+        host = url_host(url)
+        filename = None
+        part = None
         try:
             # Generate a unique filename
             filename = f'{url.split("/")[-1]}'
@@ -89,82 +346,470 @@ class DownloadManager:
                 self.save_download_result(row, filename, download_status='FALSE', download_message='Filename could not be determined')
                 return 'failed'
             
-            # Check if the file already exists
-            if os.path.exists(f'{self.folder}/{filename}'):
-                if filename.lower().endswith('.pdf'):
-                    self.save_download_result(row, filename, download_status='TRUE', download_message='File already exists in this folder')
-                    return 'already_downloaded'
+            # Skip rows that already have a file or a successful download, unless this is a refresh run
+            result = self.check_already_downloaded(row, filename) if not self.refresh else None
+            if result is not None:
+                return result
+
+            # A URL that is already stored under its digest needs no second transfer
+            result = self.check_stored_url(row, url) if self.storage.mode == 'cas' else None
+            if result is not None:
+                return result
 
-            # Start a new SQLAlchemy session
-            with self.SessionLocal() as session:
-                # Query the database for a record with the specified brnumber and download_status='TRUE'
-                pdf = session.query(GRIPdf).filter_by(brnumber=brnumber, download_status='TRUE').first()
-
-                # If such a record exists, return 'already_downloaded'
-                if pdf is not None:
-                    self.save_download_result(row, filename, download_status='TRUE', file_folder=pdf.file_folder, download_message=f'Download_status for {brnumber} was already TRUE, should be found in folder: {pdf.file_folder}, wont attempt download to folder: {self.folder}')
-                    return 'already_downloaded'
-
-            # Open the URL and read the first few bytes
-            with urllib.request.urlopen(url, timeout=10) as u:
-                if not u.read(5).startswith(b'%PDF-'):
-                    self.save_download_result(row, filename, download_status='FALSE', download_message='Not received as PDF file')
-                    return 'failed'
-    
             # Ensure the filename ends with '.pdf'
             filename = filename if filename.endswith('.pdf') else f'{filename}.pdf'
-            # Download the file
-            urllib.request.urlretrieve(url, f'{self.folder}/{filename}')
-            self.save_download_result(row, filename, download_status='TRUE', download_message='File downloaded successfully')
-            return 'successful'
+            path, headers = self.refresh_target(row, filename)
+            part = self.storage.part_file(url, path)
+
+            # Open the URL once, resuming a previous .part file if there is one
+            self.cancel_token.check()
+            request = urllib.request.Request(url, headers=part.request_headers() or headers)
+            try:
+                response = self.opener.open(request, timeout=10)
+            except urllib.error.HTTPError as e:
+                if e.code == 304:
+                    return self.save_unchanged(row, job)
+                if e.code == 416 and part.complete_from_416(e.headers):
+                    return self.save_downloaded(row, job, part, e.headers)
+                raise
+
+            # Check the first bytes and stream the rest of the same response to disk
+            with response as u:
+                if not part.begin(u.status, u.headers):
+                    head = u.read(len(PDF_MAGIC))
+                    if not head.startswith(PDF_MAGIC):
+                        # begin() already saved a validator for the part file, a page that isn't a PDF leaves nothing behind
+                        part.discard()
+                        self.save_download_result(row, filename, download_status='FALSE', download_message='Not received as PDF file', attempts=job.attempts)
+                        return 'failed'
+                    part.write(head)
+                try:
+                    while chunk := u.read(CHUNK_SIZE):
+                        self.cancel_token.check()
+                        part.write(chunk)
+                        if self.limiter:
+                            self.limiter.throttle(host, len(chunk))
+                finally:
+                    part.close()
+            return self.save_downloaded(row, job, part, u.headers)
+        except DownloadCancelled:
+            return self.cancel_download(part)
         except (socket.timeout, Exception) as e:
-            self.save_download_result(row, filename, download_status='FALSE', download_message=str(e))
-            return 'failed'
+            return self.handle_download_error(job, filename, e)
+
+    def refresh_target(self, row, filename):
+        # Path to write to and conditional headers: a refresh rewrites the stored file of the row,
+        # and only asks for it if it changed when validators for it are stored
+        if self.refresh and self.index is None:
+            self.load_index()
+        validators = self.index.validators.get(row['BRnum']) if self.refresh else None
+        if validators is None or not os.path.exists(f"{validators['file_folder']}/{validators['file_name']}"):
+            return self.storage.path(filename), {}
+        headers = {}
+        if validators['etag']:
+            headers['If-None-Match'] = validators['etag']
+        if validators['last_modified']:
+            headers['If-Modified-Since'] = validators['last_modified']
+        return f"{validators['file_folder']}/{validators['file_name']}", headers
+
+    def save_downloaded(self, row, job, part, headers):
+        # Move the finished part file into place and save the row with the validators of the response
+        path, duplicate = self.storage.commit(part)
+        message = 'Identical file already stored, linked to it' if duplicate else 'File downloaded successfully'
+        self.save_download_result(row, os.path.basename(path), download_status='TRUE', file_folder=os.path.dirname(path), download_message=message,
+                                  attempts=job.attempts, validators=response_validators(headers, part), source_url=row[job.url_header])
+        return 'successful'
+
+    def check_stored_url(self, row, url):
+        stored = self.index.sources.get(url)
+        if stored is None:
+            return None
+        file_folder, file_name = stored
+        if not os.path.exists(f'{file_folder}/{file_name}'):
+            # The file is gone, the URL is downloaded again
+            self.index.sources.pop(url, None)
+            return None
+        self.save_download_result(row, file_name, download_status='TRUE', file_folder=file_folder, download_message=f'URL already stored as {file_name}', source_url=url)
+        return 'already_downloaded'
 
-    def download_files(self, rows, nrows, max_workers=None):
+    def save_unchanged(self, row, job):
+        validators = self.index.validators[row['BRnum']]
+        self.save_download_result(row, validators['file_name'], download_status='TRUE', file_folder=validators['file_folder'], download_message='File unchanged since last download', attempts=job.attempts)
+        return 'unchanged'
+
+    def cancel_download(self, part):
+        # A cancelled transfer leaves no partial file and no result, the row is attempted again by the next task
+        if part is not None:
+            part.discard()
+        return 'cancelled'
+
+    def handle_download_error(self, job, filename, error):
+        # Record the attempt, then either leave the job to be retried or save the row as failed
+        job.error_class = classify_error(error)
+        message = str(error) or type(error).__name__
+        job.attempts.append({
+            'url_header': job.url_header,
+            'error_class': job.error_class,
+            'error': message,
+            'time': datetime.now().isoformat(timespec='seconds'),
+            'run': self.run_id,
+        })
+        attempt = sum(1 for attempt in job.attempts if attempt['url_header'] == job.url_header)
+        delay = self.retry_policy.delay(job.error_class, attempt, retry_after(error))
+        if delay is not None:
+            job.attempts[-1]['retry_in'] = round(delay, 2)
+            return 'retry'
+        self.save_download_result(job.row, filename, download_status='FALSE', download_message=message, attempts=job.attempts)
+        return 'failed'
+
+    def finish_job(self, job, result, scheduler, counters):
+        # Shared by both engines when an attempt is done: breaker, retries, fallback and counters
+        scheduler.release(job)
+        if result == 'cancelled':
+            return
+        if job.error_class in TRANSIENT_ERRORS:
+            paused_until = self.breaker.record_failure(job.host)
+            if paused_until is not None:
+                scheduler.pause(job.host, paused_until)
+        elif result != 'already_downloaded':
+            self.breaker.record_success(job.host)
+
+        if result == 'retry':
+            # The retry waits in the scheduler until it is due, without holding a worker
+            scheduler.defer(job, time.monotonic() + job.attempts[-1]['retry_in'])
+            self.count(job, counters, 'retries')
+            return
+
+        if result in counters:
+            self.count(job, counters, result)
+
+        # Increment the processed_rows counter
+        self.count(job, counters, 'processed_rows')
+
+        if result == 'failed' and job.url_header == 'Pdf_URL':
+            # If the Pdf_URL download task failed, queue the Report Html Address download task
+            scheduler.add(DownloadJob(job.row, 'Report Html Address', job.attempts, job.row_number, job.counts))
+            return
+        self.checkpoint_row(job)
+
+    @staticmethod
+    def count(job, counters, key):
+        counters[key] += 1
+        job.counts[key] = job.counts.get(key, 0) + 1
+
+    def checkpoint_row(self, job):
+        # The row is done once its result is committed, so the writer marks it after the flush
+        if self.checkpoint is None:
+            return
+        mark = lambda: self.checkpoint.mark(job.row_number, job.counts)
+        if self.writer is not None:
+            self.writer.after_flush(mark, keys=[job.row.get('BRnum', "")])
+        else:
+            mark()
+
+    def check_already_downloaded(self, row, filename):
+        brnumber = row['BRnum']
+        if self.index is None:
+            self.load_index()
+
+        # Check if the file already exists, content-addressed files are not named after their URL
+        if self.storage.mode == 'name' and filename in self.index.files:
+            if filename.lower().endswith('.pdf'):
+                self.save_download_result(row, filename, download_status='TRUE', file_folder=self.index.files[filename], download_message='File already exists in this folder')
+                return 'already_downloaded'
+
+        # If the brnumber was already downloaded, return 'already_downloaded'. The row keeps the name it is stored
+        # under, in 'cas' mode that is the digest and not the name in the URL
+        completed = self.index.completed.get(brnumber)
+        if completed is not None:
+            file_folder, stored_name = completed
+            self.save_download_result(row, stored_name if stored_name else filename, download_status='TRUE', file_folder=file_folder, download_message=f'Download_status for {brnumber} was already TRUE, should be found in folder: {file_folder}, wont attempt download to folder: {self.folder}')
+            return 'already_downloaded'
+        return None
+
+    @staticmethod
+    async def read_head_async(response, size):
+        # StreamReader.read(n) may return less than n bytes at a chunk boundary
+        head = b''
+        while len(head) < size:
+            chunk = await response.content.read(size - len(head))
+            if not chunk:
+                break
+            head += chunk
+        return head
+
+    async def download_file_async(self, http_session, row, url_header, job=None):
+        job = job if job is not None else DownloadJob(row, url_header)
+        url = row[url_header]
+        host = url_host(url)
+        filename = None
+        part = None
+        try:
+            # Generate a unique filename
+            filename = f'{url.split("/")[-1]}'
+
+            # Skip rows that already have a file or a successful download, unless this is a refresh run
+            result = self.check_already_downloaded(row, filename) if not self.refresh else None
+            if result is not None:
+                return result
+
+            # A URL that is already stored under its digest needs no second transfer
+            result = self.check_stored_url(row, url) if self.storage.mode == 'cas' else None
+            if result is not None:
+                return result
+
+            # Ensure the filename ends with '.pdf'
+            filename = filename if filename.endswith('.pdf') else f'{filename}.pdf'
+            # File and DB work runs in threads, a slow disk or NAS would otherwise stall every connection on the loop
+            path, headers = await asyncio.to_thread(self.refresh_target, row, filename)
+            part = await asyncio.to_thread(self.storage.part_file, url, path)
+
+            # Open the URL once, resuming a previous .part file if there is one
+            self.cancel_token.check()
+            try:
+                response = await http_session.get(url, headers=part.request_headers() or headers)
+            except aiohttp.ClientResponseError as e:
+                if e.status == 416 and await asyncio.to_thread(part.complete_from_416, e.headers):
+                    return await asyncio.to_thread(self.save_downloaded, row, job, part, e.headers)
+                raise
+
+            # Check the first bytes and stream the rest of the same response to disk
+            async with response:
+                if response.status == 304:
+                    return self.save_unchanged(row, job)
+                # Chunks are written in blocks of ASYNC_WRITE_SIZE, one thread hop per chunk would keep the executor busy
+                buffer = bytearray()
+                if not await asyncio.to_thread(part.begin, response.status, response.headers):
+                    head = await self.read_head_async(response, len(PDF_MAGIC))
+                    if not head.startswith(PDF_MAGIC):
+                        # begin() already saved a validator for the part file, a page that isn't a PDF leaves nothing behind
+                        await asyncio.to_thread(part.discard)
+                        self.save_download_result(row, filename, download_status='FALSE', download_message='Not received as PDF file', attempts=job.attempts)
+                        return 'failed'
+                    buffer += head
+                try:
+                    async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+                        self.cancel_token.check()
+                        buffer += chunk
+                        if len(buffer) >= ASYNC_WRITE_SIZE:
+                            await asyncio.to_thread(part.write, buffer)
+                            buffer.clear()
+                        if self.limiter:
+                            await self.limiter.throttle_async(host, len(chunk))
+                finally:
+                    # What was received is kept in the part file, a transfer that breaks off resumes after it
+                    if buffer:
+                        await asyncio.to_thread(part.write, buffer)
+                    await asyncio.to_thread(part.close)
+            return await asyncio.to_thread(self.save_downloaded, row, job, part, response.headers)
+        except DownloadCancelled:
+            return await asyncio.to_thread(self.cancel_download, part)
+        except (asyncio.TimeoutError, Exception) as e:
+            return self.handle_download_error(job, filename, e)
+
+    def download_files(self, rows, nrows, max_workers=None, max_per_host=None):
         if max_workers is None:
             max_workers = os.cpu_count() or 1
+        if max_per_host is None:
+            max_per_host = DEFAULT_MAX_PER_HOST
         print(f"Attempting to download {nrows} files to folder: {self.folder} using {max_workers} logical cpu cores")
     
         # Initialize counters
-        counters = {'successful': 0, 'already_downloaded': 0, 'failed': 0, 'processed_rows': 0}
+        counters = dict.fromkeys(DOWNLOAD_COUNTERS, 0)
+
+        # Load what is already downloaded once, instead of checking per row
+        self.load_index()
+
+        # The Pdf_URL download jobs are queued per host as the rows are read
+        scheduler = HostScheduler(max_per_host)
     
-        # Process the rows
+        # Process the rows, the results are written in batches by the writer thread
+        self.writer = DownloadResultWriter(self.SessionLocal).start()
+        try:
+            yield from self._run_executor(iter(rows), scheduler, counters, max_workers)
+        finally:
+            self.connections.close_all()
+            self.writer.close()
+            self.writer = None
+
+    @staticmethod
+    def read_rows(rows, scheduler, size):
+        # Queue rows until the scheduler holds `size` jobs, returns False once the rows are exhausted
+        while len(scheduler) < size:
+            row_number, row = next(rows, (None, None))
+            if row is None:
+                return False
+            scheduler.add(DownloadJob(row, 'Pdf_URL', row_number=row_number))
+        return True
+
+    def next_job(self, rows, scheduler, rows_left):
+        # Returns the next job and whether there are rows left. When every queued host is at its cap,
+        # read further ahead for other hosts, but never past DEFAULT_QUEUE_SIZE rows
+        job = scheduler.next()
+        while job is None and rows_left and len(scheduler) < DEFAULT_QUEUE_SIZE:
+            rows_left = self.read_rows(rows, scheduler, len(scheduler) + 1)
+            job = scheduler.next()
+        return job, rows_left
+
+    def _run_executor(self, rows, scheduler, counters, max_workers):
         with ThreadPoolExecutor(max_workers=max_workers) as executor:
             futures = {}
-            for row in rows:
-                # Submit the Pdf_URL download task to the executor
-                future = executor.submit(self.download_file, row, 'Pdf_URL')
-                futures[future] = (row, 'Pdf_URL')
-    
-            # Wait for tasks to complete and update counters
-            for future in as_completed(futures):
-                result = future.result()
-                if result in counters:
-                    counters[result] += 1
-    
-                row, url_header = futures[future]
-                if result == 'failed' and url_header == 'Pdf_URL':
-                    # If the Pdf_URL download task failed, submit the Report Html Address download task to the executor
-                    future = executor.submit(self.download_file, row, 'Report Html Address')
-                    futures[future] = (row, 'Report Html Address')
-    
-                # Increment the processed_rows counter
-                counters['processed_rows'] += 1
-    
-                # Yield the current counters
-                yield counters
+            rows_left = True
+            while futures or ((scheduler or rows_left) and not self.run_limits.reached(counters)):
+                # Keep one queued job per worker, the rest of the sheet is only read as slots free up
+                rows_left = rows_left and self.read_rows(rows, scheduler, max_workers)
+
+                # Hand out jobs while there are free workers, hosts with a free slot and the run limits allow it
+                while len(futures) < max_workers and not self.run_limits.reached(counters, len(futures)):
+                    job, rows_left = self.next_job(rows, scheduler, rows_left)
+                    if job is None:
+                        break
+                    job.error_class = None
+                    future = executor.submit(self.download_file, job.row, job.url_header, job)
+                    futures[future] = job
+                if not futures:
+                    # Only retries that aren't due yet or paused hosts are left
+                    wakeup = scheduler.wakeup()
+                    if wakeup is None:
+                        break
+                    self.cancel_token.wait(wakeup)
+                    continue
+
+                # Wait for tasks to complete, or until a retry is due, and update counters
+                done, _ = wait(futures, timeout=scheduler.wakeup(), return_when=FIRST_COMPLETED)
+                for future in done:
+                    job = futures.pop(future)
+                    self.finish_job(job, future.result(), scheduler, counters)
+
+                    # Yield the current counters
+                    yield counters
+
+    def download_files_async(self, rows, nrows, concurrency=None, max_per_host=None):
+        if concurrency is None:
+            concurrency = DEFAULT_ASYNC_CONCURRENCY
+        if max_per_host is None:
+            max_per_host = DEFAULT_MAX_PER_HOST
+        print(f"Attempting to download {nrows} files to folder: {self.folder} using {concurrency} concurrent connections")
+
+        # The event loop runs in its own thread and hands the counters back through a queue,
+        # so callers can keep consuming a plain generator from sync code
+        updates = queue.Queue()
+        errors = []
+
+        def run_loop():
+            try:
+                asyncio.run(self._download_files_async(rows, concurrency, max_per_host, updates))
+            except Exception as e:
+                errors.append(e)
+            finally:
+                updates.put(None)
+
+        loop_thread = threading.Thread(target=run_loop, daemon=True)
+        loop_thread.start()
+        while (counters := updates.get()) is not None:
+            yield counters
+        loop_thread.join()
+        if errors:
+            raise errors[0]
 
-    def start_download(self, start_row, nrows):
+    async def _download_files_async(self, rows, concurrency, max_per_host, updates):
+        # Initialize counters
+        counters = dict.fromkeys(DOWNLOAD_COUNTERS, 0)
+
+        # Load what is already downloaded once, instead of checking per row
+        await asyncio.to_thread(self.load_index)
+
+        # The Pdf_URL download jobs are queued per host as the rows are read
+        scheduler = HostScheduler(max_per_host)
+
+        # The connector keeps a keep-alive pool per origin and enforces the same caps on open sockets
+        timeout = aiohttp.ClientTimeout(total=None, sock_connect=10, sock_read=10)
+        connector = aiohttp.TCPConnector(limit=concurrency, limit_per_host=max_per_host, keepalive_timeout=30)
+        # PDFs are already compressed, and identity encoding keeps Content-Length and Range in file bytes
+        headers = {'Accept-Encoding': 'identity'}
+        self.writer = DownloadResultWriter(self.SessionLocal).start()
+        try:
+            async with aiohttp.ClientSession(connector=connector, timeout=timeout, headers=headers, raise_for_status=True) as http_session:
+                await self._run_tasks(http_session, iter(rows), scheduler, counters, concurrency, updates)
+        finally:
+            await asyncio.to_thread(self.writer.close)
+            self.writer = None
+
+    async def _run_tasks(self, http_session, rows, scheduler, counters, concurrency, updates):
+        tasks = {}
+        rows_left = True
+        while tasks or ((scheduler or rows_left) and not self.run_limits.reached(counters)):
+            # Keep one queued job per slot, the rest of the sheet is only read as slots free up.
+            # Reading rows parses the sheet or pages the DB, so it runs in a thread
+            if rows_left and len(scheduler) < concurrency:
+                rows_left = await asyncio.to_thread(self.read_rows, rows, scheduler, concurrency)
+
+            # Hand out jobs while there are free slots, hosts with a free slot and the run limits allow it
+            while len(tasks) < concurrency and not self.run_limits.reached(counters, len(tasks)):
+                job = scheduler.next()
+                if job is None:
+                    job, rows_left = await asyncio.to_thread(self.next_job, rows, scheduler, rows_left)
+                if job is None:
+                    break
+                job.error_class = None
+                task = asyncio.create_task(self.download_file_async(http_session, job.row, job.url_header, job))
+                tasks[task] = job
+            if not tasks:
+                # Only retries that aren't due yet or paused hosts are left
+                wakeup = scheduler.wakeup()
+                if wakeup is None:
+                    break
+                await asyncio.to_thread(self.cancel_token.wait, wakeup)
+                continue
+
+            # Wait for tasks to complete, or until a retry is due, and update counters
+            done, _ = await asyncio.wait(tasks, timeout=scheduler.wakeup(), return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                job = tasks.pop(task)
+                self.finish_job(job, task.result(), scheduler, counters)
+
+                # Hand a snapshot of the counters to the consuming thread
+                updates.put(dict(counters))
+
+    def start_download(self, start_row, nrows, engine='thread', concurrency=None, max_per_host=None,
+                       bandwidth_limit=None, host_bandwidth_limit=None, max_run_time=None, max_files=None, refresh=False, storage='name',
+                       cancel_token=None, checkpoint=None, source='sheet', message_pattern=None, attempted_before=None, deadline=None):
+        if engine not in DOWNLOAD_ENGINES:
+            raise ValueError(f"Unsupported download engine: {engine}")
+        if source not in DOWNLOAD_SOURCES:
+            raise ValueError(f"Unsupported download source: {source}")
         start_time = time.time()
-        rows = self.load_data(start=start_row, nrows=nrows)
+        # Bandwidth limits are in bytes/second, max_run_time in seconds and deadline a timestamp
+        self.limiter = BandwidthLimiter(bandwidth_limit, host_bandwidth_limit)
+        self.cancel_token = cancel_token if cancel_token else CancelToken()
+        self.run_limits = RunLimits(max_run_time, max_files, self.cancel_token, deadline)
+        self.refresh = refresh
+        self.storage = PdfStorage(self.folder, storage)
+        # A resumed task continues from its checkpoint and skips the rows that finished out of order
+        self.checkpoint = checkpoint if checkpoint else RowCheckpoint(start_row)
+        remaining = self.checkpoint.remaining(nrows)
+        if remaining is not None and remaining <= 0:
+            return
+        if source == 'failed':
+            # The sheet is never opened, the work is proportional to the failed rows. The rows have no position,
+            # the checkpoint only counts them
+            if isinstance(attempted_before, str):
+                attempted_before = datetime.fromisoformat(attempted_before)
+            rows = ((None, row) for row in self.load_failed(remaining, message_pattern, attempted_before))
+        else:
+            rows = ((row_number, row) for row_number, row in enumerate(self.load_data(start=self.checkpoint.next_row, nrows=remaining), self.checkpoint.next_row)
+                    if not self.checkpoint.is_done(row_number))
+        if engine == 'async':
+            results = self.download_files_async(rows, nrows, concurrency=concurrency, max_per_host=max_per_host)
+        else:
+            results = self.download_files(rows, nrows, max_workers=concurrency, max_per_host=max_per_host)
     
         # Initialize counters
         counters = {'successful': 0, 'already_downloaded': 0, 'failed': 0}
     
         # Process the rows
         with tqdm(total=nrows) as pbar:
-            for result in self.download_files(rows, nrows):
+            for result in results:
                 counters.update(result)
     
                 # Calculate the elapsed time
@@ -0,0 +1,236 @@
+from sqlalchemy import update, case
+from sqlalchemy.orm import sessionmaker
+from db_classes import RunningTask, TaskJob
+from db_connect import SyncDatabaseConnect
+from db_download_manager import DownloadManager
+from db_download_limits import CancelToken
+from db_checkpoint import RowCheckpoint
+from db_progress import progress_bus, PROGRESS_CHECKPOINT_INTERVAL, PROGRESS_DB_INTERVAL
+from datetime import datetime
+from dotenv import load_dotenv
+import argparse
+import threading
+import socket
+import json
+import time
+import uuid
+import os
+
+load_dotenv()
+
+# 'inprocess' runs a worker thread inside the API, 'external' leaves the queue to db_download_worker.py processes
+DOWNLOAD_WORKER_MODE = os.getenv('DOWNLOAD_WORKER_MODE', 'inprocess')
+# Seconds a claimed job stays leased without a heartbeat, heartbeats are sent three times per lease
+DOWNLOAD_LEASE_SECONDS = int(os.getenv('DOWNLOAD_LEASE_SECONDS', 60))
+# Seconds an idle worker waits before polling the queue again
+DOWNLOAD_POLL_INTERVAL = float(os.getenv('DOWNLOAD_POLL_INTERVAL', 2))
+# Claims per job, a job whose worker keeps dying is failed after this many
+DOWNLOAD_MAX_ATTEMPTS = int(os.getenv('DOWNLOAD_MAX_ATTEMPTS', 3))
+# Worker threads started by the API in 'inprocess' mode, more than one runs the shards of a task side by side
+DOWNLOAD_INPROCESS_WORKERS = int(os.getenv('DOWNLOAD_INPROCESS_WORKERS', 1))
+
+# Cancel tokens of the jobs running in this process by task and job id, the API sets them directly in 'inprocess' mode
+cancel_tokens = {}
+cancel_lock = threading.Lock()
+
+def cancel_local(task_id):
+    # Cancel every job of the task running in this process, returns whether there was one
+    with cancel_lock:
+        tokens = list(cancel_tokens.get(task_id, {}).values())
+    for token in tokens:
+        token.cancel()
+    return bool(tokens)
+
+def enqueue_task(session, task_id, options, shard=0):
+    # Queue a download job for a RunningTask, the caller commits
+    job = TaskJob(task_id=task_id, status='queued', options=json.dumps(options), shard=shard)
+    session.add(job)
+    return job
+
+class DownloadWorker:
+    def __init__(self, worker_id=None, lease_seconds=DOWNLOAD_LEASE_SECONDS, poll_interval=DOWNLOAD_POLL_INTERVAL, max_attempts=DOWNLOAD_MAX_ATTEMPTS,
+                 progress_interval=PROGRESS_DB_INTERVAL):
+        self.worker_id = worker_id if worker_id else f'{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}'
+        # Seconds between the checkpoints of a job, they are the only progress the API sees of a worker process
+        self.progress_interval = progress_interval
+        self.lease_seconds = lease_seconds
+        self.poll_interval = poll_interval
+        self.max_attempts = max_attempts
+        db_connect = SyncDatabaseConnect()
+        self.engine = db_connect.get_engine()
+        self.SessionLocal = sessionmaker(self.engine, expire_on_commit=False)
+        self.stop_event = threading.Event()
+
+    def stop(self):
+        self.stop_event.set()
+
+    def run(self):
+        print(f"Download worker {self.worker_id} polling for jobs")
+        while not self.stop_event.is_set():
+            try:
+                job = self.claim()
+            except Exception as e:
+                # The DB may be restarting, keep polling
+                print(f"Download worker {self.worker_id} could not poll the queue: {e}")
+                job = None
+            if job is None:
+                self.stop_event.wait(self.poll_interval)
+                continue
+            self.run_job(job)
+
+    def claim(self):
+        with self.SessionLocal() as session:
+            for task_id in TaskJob.fail_exhausted(session, self.max_attempts):
+                self.finish_task(task_id)
+            return TaskJob.claim(session, self.worker_id, self.lease_seconds, self.max_attempts)
+
+    def heartbeat(self, job, cancel_token, done):
+        # Extends the lease until the job is done. A lost lease or a cancelled job stops the downloads
+        while not done.wait(self.lease_seconds / 3):
+            try:
+                with self.SessionLocal() as session:
+                    if not TaskJob.heartbeat(session, job.id, self.worker_id, self.lease_seconds):
+                        cancel_token.cancel()
+                        return
+            except Exception as e:
+                print(f"Download worker {self.worker_id} missed a heartbeat for job {job.id}: {e}")
+
+    def run_job(self, job):
+        options = json.loads(job.options)
+        cancel_token = CancelToken()
+        with cancel_lock:
+            cancel_tokens.setdefault(job.task_id, {})[job.id] = cancel_token
+        done = threading.Event()
+        heartbeat = threading.Thread(target=self.heartbeat, args=(job, cancel_token, done), daemon=True)
+        heartbeat.start()
+        status, error, checkpoint = 'failed', None, None
+        try:
+            with self.SessionLocal() as session:
+                checkpoint = self.download_task(job, session, cancel_token, **options)
+            status = 'cancelled' if cancel_token.cancelled else 'finished'
+        except Exception as e:
+            error = str(e)
+            print(f"Download worker {self.worker_id} failed job {job.id}: {e}")
+        finally:
+            done.set()
+            heartbeat.join()
+            with cancel_lock:
+                tokens = cancel_tokens.get(job.task_id, {})
+                tokens.pop(job.id, None)
+                if not tokens:
+                    cancel_tokens.pop(job.task_id, None)
+            with self.SessionLocal() as session:
+                # A failed job keeps its last saved checkpoint, it resumes from there when requeued
+                if checkpoint is not None:
+                    TaskJob.finish(session, job.id, self.worker_id, status, error, checkpoint.results(), checkpoint.dumps())
+                else:
+                    TaskJob.finish(session, job.id, self.worker_id, status, error)
+            self.finish_task(job.task_id)
+            # After finish_task, so the task is answered from the bus until its counters are in the DB
+            progress_bus.release(job.task_id, job.id)
+
+    def download_task(self, job, session, cancel_token, filename, start_row, num_rows, **options):
+        # Runs the row range of one job and returns its checkpoint. A job claimed again after its worker died
+        # continues from the checkpoint that worker saved last
+        task_id = job.task_id
+        dm = DownloadManager(folder='pdf-files', file_with_urls=f'pdf-urls/{filename}')
+        # The task is running once the first of its jobs is claimed, a cancel while it was queued is kept.
+        # A resumed task has run before and keeps its start_time, so running_time covers all of its runs
+        session.execute(update(RunningTask).where(RunningTask.task_id == task_id, RunningTask.status == "queued").values(
+            status="running", start_time=case((RunningTask.end_time.is_(None), datetime.now()), else_=RunningTask.start_time)))
+        session.commit()
+        task = session.get(RunningTask, task_id)
+        if task.status != "running":
+            cancel_token.cancel()
+            return None
+
+        checkpoint = RowCheckpoint.load(job.checkpoint, start_row)
+        if checkpoint.next_row != start_row or checkpoint.done:
+            print(f"Download worker {self.worker_id} resuming job {job.id} at row {checkpoint.next_row}")
+        # The counters of the task's other jobs and of the rows this job did before, what it publishes is added to them
+        resumed = checkpoint.results()
+        others = add_counters(TaskJob.task_results(session, task_id, exclude_id=job.id), resumed)
+        progress_bus.start(task_id, job.id, start_time=task.start_time, start_row=task.start_row, num_rows=task.num_rows, running_file=task.running_file)
+        last_commit_time = time.time()
+        for result in dm.start_download(start_row, num_rows, cancel_token=cancel_token, checkpoint=checkpoint, **options):
+            # Live progress goes to the bus, the DB only gets a checkpoint every progress_interval seconds
+            progress_bus.publish(task_id, add_counters(others, result))
+            current_time = time.time()
+            if current_time - last_commit_time >= self.progress_interval:
+                # No row left running means the task was cancelled from another process
+                if not self.checkpoint(session, job, checkpoint):
+                    cancel_token.cancel()
+                others = add_counters(TaskJob.task_results(session, task_id, exclude_id=job.id), resumed)
+                last_commit_time = current_time
+        return checkpoint
+
+    def checkpoint(self, session, job, checkpoint):
+        # Save the rows this job has done, their counters and the sum over all jobs into the task,
+        # False when the task was cancelled
+        TaskJob.save_results(session, job.id, checkpoint.results(), checkpoint.dumps())
+        totals = TaskJob.task_results(session, job.task_id)
+        stmt = (
+            update(RunningTask).
+            where(RunningTask.task_id == job.task_id, RunningTask.status == "running").
+            values(results=json.dumps(totals), end_time=datetime.now(), processed_rows=totals.get('processed_rows', 0))
+        )
+        running = session.execute(stmt).rowcount == 1
+        session.commit()
+        return running
+
+    def finish_task(self, task_id):
+        # The worker that finishes the last job of a task writes the final counters and status of the task
+        with self.SessionLocal() as session:
+            statuses = TaskJob.task_statuses(session, task_id)
+            totals = TaskJob.task_results(session, task_id)
+            if statuses & {'queued', 'running'}:
+                # Other jobs are left, the task gets the counters so far
+                session.execute(update(RunningTask).where(RunningTask.task_id == task_id, RunningTask.status == "running").values(
+                    results=json.dumps(totals), end_time=datetime.now(), processed_rows=totals.get('processed_rows', 0)))
+                session.commit()
+                return
+            status = 'failed' if 'failed' in statuses else 'cancelled' if 'cancelled' in statuses else 'finished'
+            # A cancel that came in after the last checkpoint is kept
+            stmt = (
+                update(RunningTask).
+                where(RunningTask.task_id == task_id).
+                values(status=case((RunningTask.status == "cancelled", "cancelled"), else_=status), results=json.dumps(totals) if totals else None,
+                       end_time=datetime.now(), processed_rows=totals.get('processed_rows', 0))
+            )
+            session.execute(stmt)
+            session.commit()
+        # Only dropped from the bus once the final state is in the DB, /download_results reads it from there
+        progress_bus.finish(task_id, status)
+
+def add_counters(*counters):
+    totals = {}
+    for item in counters:
+        for key, value in item.items():
+            totals[key] = totals.get(key, 0) + value
+    return totals
+
+def split_rows(start_row, num_rows, shards):
+    # Row ranges of about the same size, one per shard
+    size = -(-num_rows // shards)
+    return [(start, min(size, start_row + num_rows - start)) for start in range(start_row, start_row + num_rows, size)]
+
+def split_limit(value, shards):
+    # A task-wide limit shared out over the shards, the first ones get the remainder
+    if value is None:
+        return [None] * shards
+    return [value // shards + (1 if shard < value % shards else 0) for shard in range(shards)]
+
+def start_inprocess_workers(count=DOWNLOAD_INPROCESS_WORKERS):
+    # Runs the queue inside the API process, for setups without a separate worker. Their progress
+    # reaches the API through the bus, so the DB only needs the occasional checkpoint
+    workers = [DownloadWorker(progress_interval=PROGRESS_CHECKPOINT_INTERVAL) for _ in range(count)]
+    for worker in workers:
+        threading.Thread(target=worker.run, daemon=True).start()
+    return workers
+
+if __name__ == '__main__':
+    # python db_download_worker.py, run as many as needed next to the API with DOWNLOAD_WORKER_MODE=external
+    parser = argparse.ArgumentParser(description='Run download jobs from the task_jobs queue')
+    parser.add_argument('--worker-id', default=None)
+    args = parser.parse_args()
+    DownloadWorker(worker_id=args.worker_id).run()
@@ -0,0 +1,94 @@
+from db_classes import GRIPdf
+import threading
+import queue
+import time
+import os
+
+# Results are flushed when a batch is full or when the oldest result has waited this long
+DEFAULT_BATCH_SIZE = int(os.getenv('DOWNLOAD_WRITE_BATCH_SIZE', 200))
+DEFAULT_FLUSH_INTERVAL = float(os.getenv('DOWNLOAD_WRITE_FLUSH_INTERVAL', 1.0))
+
+class DownloadResultWriter:
+    # Collects GRIPdf.row_data dicts from the download workers on a queue, and a single writer thread
+    # flushes them as one bulk upsert in one transaction per batch
+    def __init__(self, SessionLocal, batch_size=None, flush_interval=None):
+        self.SessionLocal = SessionLocal
+        self.batch_size = batch_size if batch_size else DEFAULT_BATCH_SIZE
+        self.flush_interval = flush_interval if flush_interval else DEFAULT_FLUSH_INTERVAL
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.written = 0
+        # brnumbers whose latest result the DB refused, their rows are not checkpointed
+        self.failed = set()
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def put(self, data):
+        self.queue.put(data)
+
+    def after_flush(self, callback, keys=()):
+        # Call back from the writer thread once everything put before it is committed,
+        # unless the result of one of the brnumbers in keys could not be written
+        self.queue.put((callback, tuple(keys)))
+
+    def close(self):
+        # Flush whatever is left and wait for the writer thread to finish
+        self.queue.put(None)
+        self.thread.join()
+
+    def run(self):
+        batch = {}
+        callbacks = []
+        deadline = None
+        while True:
+            timeout = max(0, deadline - time.monotonic()) if batch else None
+            try:
+                data = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                data = {}
+
+            if data is None:
+                self.flush(batch, callbacks)
+                return
+            if isinstance(data, tuple):
+                callbacks.append(data)
+                if not batch:
+                    self.flush(batch, callbacks)
+                    callbacks = []
+                continue
+            if data:
+                # Only the latest result per brnumber is kept, e.g. a successful fallback after a failed Pdf_URL
+                if not batch:
+                    deadline = time.monotonic() + self.flush_interval
+                batch[data['brnumber']] = data
+
+            if len(batch) >= self.batch_size or (batch and time.monotonic() >= deadline):
+                self.flush(batch, callbacks)
+                batch = {}
+                callbacks = []
+
+    def flush(self, batch, callbacks=()):
+        if batch:
+            self.write(list(batch.values()))
+        for callback, keys in callbacks:
+            if not self.failed.intersection(keys):
+                callback()
+
+    def write(self, rows):
+        # One bulk upsert per batch. A batch the DB refuses, e.g. over a missing or too long brnumber,
+        # is split in halves until only the rows it refuses are left, so the others are still written
+        with self.SessionLocal() as session:
+            written = GRIPdf.bulk_upsert(session, rows)
+        if written:
+            self.written += written
+            self.failed.difference_update(row['brnumber'] for row in rows)
+            return
+        if len(rows) == 1:
+            print(f"Could not write the download result of BRnum {rows[0]['brnumber']!r}, the row is not checkpointed")
+            self.failed.add(rows[0]['brnumber'])
+            return
+        middle = len(rows) // 2
+        self.write(rows[:middle])
+        self.write(rows[middle:])
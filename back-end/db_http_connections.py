@@ -0,0 +1,122 @@
+import urllib.request
+import urllib.error
+import http.client
+import threading
+import os
+
+# Open connections kept per worker thread, the least recently used host is closed past this many
+DOWNLOAD_KEEPALIVE_HOSTS = int(os.getenv('DOWNLOAD_KEEPALIVE_HOSTS', 8))
+
+# A reused connection the server has closed in the meantime fails with one of these before any response is read
+STALE_CONNECTION_ERRORS = (http.client.RemoteDisconnected, ConnectionResetError, ConnectionAbortedError, BrokenPipeError)
+
+class KeepAliveResponse(http.client.HTTPResponse):
+    # Remembers whether the body was left unread, the connection can only carry the next request once it is read to the end
+    unread = False
+
+    def close(self):
+        if self.fp is not None:
+            self.unread = True
+        super().close()
+
+    def reusable(self):
+        return self.isclosed() and not self.unread and not self.will_close
+
+class KeepAliveHandler(urllib.request.HTTPHandler, urllib.request.HTTPSHandler):
+    # Replaces urllib's handlers, which open a new TCP and TLS connection for every request. Each thread keeps its
+    # connections per host and sends the next request to the same host over the connection of the last one
+    def __init__(self, max_hosts=DOWNLOAD_KEEPALIVE_HOSTS):
+        super().__init__()
+        self.max_hosts = max_hosts
+        self.local = threading.local()
+        # The connections of every thread, so they can be closed when a run ends
+        self.pools = []
+        self.pools_lock = threading.Lock()
+
+    def thread_pool(self):
+        pool = getattr(self.local, 'pool', None)
+        if pool is None:
+            pool = self.local.pool = {}
+            with self.pools_lock:
+                self.pools.append(pool)
+        return pool
+
+    def take(self, pool, key):
+        # The connection of the last request to the host, if its response was read to the end
+        entry = pool.pop(key, None)
+        if entry is None:
+            return None
+        connection, response = entry
+        if response is not None and response.reusable():
+            return connection
+        connection.close()
+        return None
+
+    def put(self, pool, key, connection, response):
+        pool[key] = (connection, response)
+        while len(pool) > self.max_hosts:
+            oldest = next(iter(pool))
+            pool.pop(oldest)[0].close()
+
+    @staticmethod
+    def send(connection, req, headers):
+        # Errors like urllib's: a request that can't be sent is a URLError, the errors of the response are raised as they are
+        try:
+            connection.request(req.get_method(), req.selector, req.data, headers, encode_chunked=req.has_header('Transfer-encoding'))
+        except OSError as err:
+            raise urllib.error.URLError(err)
+        return connection.getresponse()
+
+    def do_open(self, http_class, req, **http_conn_args):
+        # Proxy tunnels keep urllib's one connection per request
+        if req._tunnel_host:
+            return super().do_open(http_class, req, **http_conn_args)
+        host = req.host
+        if not host:
+            raise urllib.error.URLError('no host given')
+
+        headers = dict(req.unredirected_hdrs)
+        headers.update({k: v for k, v in req.headers.items() if k not in headers})
+        headers = {name.title(): val for name, val in headers.items()}
+
+        pool = self.thread_pool()
+        key = (http_class, host)
+        connection = self.take(pool, key)
+        reused = connection is not None
+        while True:
+            if connection is None:
+                connection = http_class(host, timeout=req.timeout, **http_conn_args)
+                connection.set_debuglevel(self._debuglevel)
+                connection.response_class = KeepAliveResponse
+            else:
+                connection.timeout = req.timeout
+                if connection.sock is not None:
+                    connection.sock.settimeout(req.timeout)
+            try:
+                response = self.send(connection, req, headers)
+            except (urllib.error.URLError, *STALE_CONNECTION_ERRORS) as err:
+                connection.close()
+                if reused and isinstance(getattr(err, 'reason', err), STALE_CONNECTION_ERRORS):
+                    # The server closed the idle connection, the request is sent once more over a new one
+                    connection, reused = None, False
+                    continue
+                raise
+            except:
+                connection.close()
+                raise
+            break
+
+        # The connection goes back to the thread's pool, the next request to the host checks that this response was read
+        self.put(pool, key, connection, response)
+        response.url = req.get_full_url()
+        response.msg = response.reason
+        return response
+
+    def close_all(self):
+        with self.pools_lock:
+            pools = list(self.pools)
+        for pool in pools:
+            for key in list(pool):
+                entry = pool.pop(key, None)
+                if entry is not None:
+                    entry[0].close()
@@ -0,0 +1,82 @@
+from sqlalchemy import create_engine, update, bindparam, or_
+from sqlalchemy.orm import sessionmaker
+from db_classes import GRIPdf
+from db_connect import SyncDatabaseConnect
+from db_pdf_storage import PdfStorage, STORAGE_LAYOUTS, is_shard_dir
+from pathlib import Path
+import argparse
+import os
+
+# Rows updated per statement while migrating
+DEFAULT_MIGRATE_BATCH_SIZE = int(os.getenv('PDF_MIGRATE_BATCH_SIZE', 1000))
+
+def migrate_layout(folder='pdf-files', layout='sharded', batch_size=DEFAULT_MIGRATE_BATCH_SIZE):
+    # Moves the files of a download folder in place into the given layout and points GRIPdf.file_folder
+    # at the new location. A batch of files is moved before its rows are updated, get_pdf_file looks in
+    # both layouts so rows are served while this runs, and an interrupted migration can simply be run again
+    storage = PdfStorage(Path(__file__).parent / folder, layout=layout)
+    engine = create_engine(SyncDatabaseConnect().get_db_url())
+    SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+    other_layouts = [other for other in STORAGE_LAYOUTS if other != layout]
+
+    # Rows are matched by file name in either layout's folder, this also fixes rows left behind by an interrupted run
+    statement = update(GRIPdf.__table__).where(
+        GRIPdf.file_name == bindparam('b_file_name'),
+        or_(*[GRIPdf.file_folder == bindparam(f'b_{other}') for other in other_layouts]),
+    ).values(file_folder=bindparam('b_file_folder'))
+
+    counters = {'moved': 0, 'in_place': 0, 'files_checked': 0}
+    batch = []
+    # List the folder first, files moved into the shard subfolders would otherwise be listed again
+    # Unfinished downloads wait in .incoming under their URL, they don't depend on the layout and stay there
+    for file_folder, file_name in list(storage.list_files()):
+        target_folder = storage.folder_for(file_name)
+        if os.path.normpath(file_folder) == os.path.normpath(target_folder):
+            counters['in_place'] += 1
+        else:
+            os.makedirs(target_folder, exist_ok=True)
+            os.replace(f'{file_folder}/{file_name}', f'{target_folder}/{file_name}')
+            counters['moved'] += 1
+        params = {'b_file_name': file_name, 'b_file_folder': str(target_folder)}
+        for other in other_layouts:
+            params[f'b_{other}'] = str(storage.folder_for(file_name, other))
+        batch.append(params)
+        if len(batch) >= batch_size:
+            update_rows(SessionLocal, statement, batch)
+            counters['files_checked'] += len(batch)
+            batch = []
+    if batch:
+        update_rows(SessionLocal, statement, batch)
+        counters['files_checked'] += len(batch)
+
+    if layout == 'flat':
+        remove_empty_shards(storage)
+    engine.dispose()
+    return counters
+
+def update_rows(SessionLocal, statement, batch):
+    # One executemany per batch instead of a statement per file
+    with SessionLocal() as session:
+        session.connection().execute(statement, batch)
+        session.commit()
+
+def remove_empty_shards(storage):
+    # Only the shard subfolders are removed, anything else in the folder is left alone
+    for first in os.scandir(storage.folder):
+        if not first.is_dir() or not is_shard_dir(first.name):
+            continue
+        for second in os.scandir(first.path):
+            if second.is_dir() and is_shard_dir(second.name) and not os.listdir(second.path):
+                os.rmdir(second.path)
+        if not os.listdir(first.path):
+            os.rmdir(first.path)
+
+if __name__ == '__main__':
+    # python db_pdf_migrate.py --folder pdf-files --layout sharded
+    # Set PDF_STORAGE_LAYOUT to the same layout afterwards, so new downloads land in it as well
+    parser = argparse.ArgumentParser(description='Move the downloaded PDFs into another folder layout')
+    parser.add_argument('--folder', default='pdf-files')
+    parser.add_argument('--layout', default='sharded', choices=STORAGE_LAYOUTS)
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_MIGRATE_BATCH_SIZE)
+    args = parser.parse_args()
+    print(migrate_layout(args.folder, args.layout, args.batch_size))
@@ -0,0 +1,212 @@
+from pathlib import Path
+import hashlib
+import os
+import re
+
+CHUNK_SIZE = 64 * 1024
+
+# 'name' stores a file under the last segment of its URL, 'cas' under the sha256 of its content
+STORAGE_MODES = ['name', 'cas']
+
+# 'flat' keeps every file directly in the folder, 'sharded' spreads them over two levels of
+# subfolders named after the hash of the file name, e.g. pdf-files/3f/a2/report.pdf
+STORAGE_LAYOUTS = ['flat', 'sharded']
+DEFAULT_LAYOUT = os.getenv('PDF_STORAGE_LAYOUT', 'flat')
+
+def shard(file_name):
+    # Two levels of 256 subfolders keep each directory small enough for fast lookups on network shares
+    digest = hashlib.sha1(file_name.encode()).hexdigest()
+    return digest[:2], digest[2:4]
+
+def is_shard_dir(name):
+    return len(name) == 2 and all(c in '0123456789abcdef' for c in name)
+
+class IncompleteDownloadError(IOError):
+    pass
+
+def strong_validator(headers):
+    # What If-Range can check a resumed transfer against: a strong ETag, or else the Last-Modified date.
+    # Weak ETags can't be used for ranges, without either the part file can't be trusted
+    etag = headers.get('ETag') if headers else None
+    if etag and not etag.startswith('W/'):
+        return etag
+    return headers.get('Last-Modified') if headers else None
+
+def content_range(header):
+    # Parse 'bytes start-end/total' or 'bytes */total' into (start, total)
+    match = re.match(r'bytes (?:(\d+)-\d+|\*)/(\d+|\*)', header or '')
+    if not match:
+        return None, None
+    start, total = match.groups()
+    return (int(start) if start else None), (int(total) if total != '*' else None)
+
+class PartFile:
+    # Streams a download into a .part file and renames it into place once complete, so an interrupted
+    # transfer never looks like a finished file and the next attempt can resume it with a Range request.
+    # The validator of the response that started the file is kept next to it and sent as If-Range, so a
+    # remote file that changed since is sent whole instead of appended to the old bytes
+    def __init__(self, path, part_path=None):
+        self.path = path
+        self.part_path = part_path if part_path else f'{path}.part'
+        self.validator_path = f'{self.part_path}.validator'
+        self.validator = None
+        if os.path.exists(self.validator_path):
+            with open(self.validator_path) as f:
+                self.validator = f.read().strip() or None
+        # A part file without a validator is started over
+        self.offset = os.path.getsize(self.part_path) if self.validator and os.path.exists(self.part_path) else 0
+        self.expected = None
+        self.written = 0
+        self.mode = 'wb'
+        self.file = None
+        # The content hash is computed while the file streams in
+        self.hash = hashlib.sha256()
+
+    def hash_existing(self, path):
+        with open(path, 'rb') as f:
+            while chunk := f.read(CHUNK_SIZE):
+                self.hash.update(chunk)
+
+    def request_headers(self):
+        return {'Range': f'bytes={self.offset}-', 'If-Range': self.validator} if self.offset else {}
+
+    def begin(self, status, headers):
+        # Only append when the server answered with the range we asked for, of the same file, otherwise start over
+        resumed = bool(self.offset) and status == 206 and content_range(headers.get('Content-Range'))[0] == self.offset
+        if resumed and strong_validator(headers) not in (None, self.validator):
+            # A server that ignores If-Range sends the range of a file that changed
+            self.discard()
+            raise IncompleteDownloadError('Remote file changed since the partial download')
+        if not resumed and status == 206:
+            self.discard()
+            raise IncompleteDownloadError('Received a range that does not fit the partial download')
+        if resumed:
+            self.hash_existing(self.part_path)
+        else:
+            self.offset = 0
+            self.save_validator(strong_validator(headers))
+        self.mode = 'ab' if resumed else 'wb'
+        self.written = self.offset
+        length = headers.get('Content-Length')
+        self.expected = self.offset + int(length) if length and length.isdigit() else None
+        return resumed
+
+    def save_validator(self, validator):
+        self.validator = validator
+        if validator:
+            with open(self.validator_path, 'w') as f:
+                f.write(validator)
+        elif os.path.exists(self.validator_path):
+            os.remove(self.validator_path)
+
+    def write(self, data):
+        if self.file is None:
+            self.file = open(self.part_path, self.mode)
+        self.file.write(data)
+        self.hash.update(data)
+        self.written += len(data)
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def finish(self):
+        self.close()
+        if self.expected is not None and self.written != self.expected:
+            raise IncompleteDownloadError(f'Incomplete download: received {self.written} of {self.expected} bytes')
+
+    def commit(self, path=None):
+        self.finish()
+        os.replace(self.part_path, path if path else self.path)
+        self.save_validator(None)
+
+    def discard(self):
+        self.close()
+        if os.path.exists(self.part_path):
+            os.remove(self.part_path)
+        self.save_validator(None)
+
+    def complete_from_416(self, headers):
+        # A 416 for our Range means the part file is already the whole file, or it no longer matches the remote one
+        total = content_range(headers.get('Content-Range') if headers else None)[1]
+        if self.offset and total == self.offset:
+            self.hash_existing(self.part_path)
+            self.written = self.expected = self.offset
+            return True
+        self.discard()
+        return False
+
+class PdfStorage:
+    # Decides where downloads are written. In 'cas' mode the final name is the digest of the content,
+    # so identical reports served under different URLs are stored once, and different reports that
+    # share a name like report.pdf don't collide
+    def __init__(self, folder, mode='name', layout=None):
+        layout = layout if layout else DEFAULT_LAYOUT
+        if mode not in STORAGE_MODES:
+            raise ValueError(f"Unsupported storage mode: {mode}")
+        if layout not in STORAGE_LAYOUTS:
+            raise ValueError(f"Unsupported storage layout: {layout}")
+        self.folder = Path(folder)
+        self.mode = mode
+        self.layout = layout
+        # Downloads are named after their URL until they are complete, so a part file is only ever resumed
+        # from the URL it came from, even when other URLs end in the same file name
+        self.incoming = self.folder / '.incoming'
+        os.makedirs(self.incoming, exist_ok=True)
+
+    def folder_for(self, file_name, layout=None):
+        if (layout if layout else self.layout) == 'sharded':
+            return self.folder.joinpath(*shard(file_name))
+        return self.folder
+
+    def path(self, file_name):
+        return f'{self.folder_for(file_name)}/{file_name}'
+
+    def locate(self, file_folder, file_name):
+        # Path of a stored file, also looked up in the other layout so rows keep working while a folder is migrated
+        candidates = [f'{file_folder}/{file_name}'] if file_folder else []
+        candidates += [f'{self.folder_for(file_name, layout)}/{file_name}' for layout in STORAGE_LAYOUTS]
+        for path in candidates:
+            if os.path.isfile(path):
+                return path
+        return None
+
+    def list_files(self):
+        # Yields (file_folder, file_name) for the files in the folder and in the shard subfolders
+        with os.scandir(self.folder) as entries:
+            first_level = []
+            for entry in entries:
+                if entry.is_file():
+                    yield str(self.folder), entry.name
+                elif entry.is_dir() and is_shard_dir(entry.name):
+                    first_level.append(entry.path)
+        for first in first_level:
+            with os.scandir(first) as entries:
+                second_level = [entry.path for entry in entries if entry.is_dir() and is_shard_dir(entry.name)]
+            for second in second_level:
+                with os.scandir(second) as entries:
+                    for entry in entries:
+                        if entry.is_file():
+                            yield second, entry.name
+
+    def part_file(self, url, path):
+        part_path = f'{self.incoming}/{hashlib.sha1(url.encode()).hexdigest()}.part'
+        if self.mode == 'cas':
+            return PartFile(None, part_path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        return PartFile(path, part_path)
+
+    def commit(self, part):
+        # Move a complete part file into place, returns the final path and whether it was a duplicate
+        if self.mode != 'cas':
+            part.commit()
+            return part.path, False
+        path = self.path(f'{part.hash.hexdigest()}.pdf')
+        if os.path.exists(path):
+            part.finish()
+            part.discard()
+            return path, True
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        part.commit(path)
+        return path, False
@@ -0,0 +1,110 @@
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session, object_session
+from db_classes import User
+from collections import OrderedDict
+from dotenv import load_dotenv
+import threading
+import time
+import os
+
+load_dotenv()
+
+# Signed in users kept in memory, so an authenticated request doesn't load its user from the DB again
+AUTH_CACHE_SIZE = int(os.getenv('AUTH_CACHE_SIZE', 1024))
+# Seconds a cached user is used, this also bounds how long changes made by another process go unseen
+AUTH_CACHE_TTL = float(os.getenv('AUTH_CACHE_TTL', 60))
+# Seconds after a token is issued during which its signed claims are trusted without looking up the user,
+# 0 turns it off. A user removed or demoted in that window keeps access until it ends
+AUTH_TRUST_CLAIMS_SECONDS = float(os.getenv('AUTH_TRUST_CLAIMS_SECONDS', 0))
+
+class Principal:
+    # What the endpoints use of the signed in user, a plain copy so no ORM row outlives its session
+    def __init__(self, username, is_admin, id=None, email=None):
+        self.username = username
+        self.is_admin = is_admin
+        self.id = id
+        self.email = email
+
+    @classmethod
+    def from_user(cls, user):
+        return cls(user.username, user.is_admin, user.id, user.email)
+
+class PrincipalCache:
+    # Bounded LRU of principals by token subject, entries expire after ttl seconds
+    def __init__(self, max_size=AUTH_CACHE_SIZE, ttl=AUTH_CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, username):
+        with self.lock:
+            entry = self.entries.get(username)
+            if entry is None:
+                return None
+            principal, expires = entry
+            if expires < time.monotonic():
+                del self.entries[username]
+                return None
+            self.entries.move_to_end(username)
+            return principal
+
+    def put(self, principal):
+        if self.max_size < 1 or self.ttl <= 0:
+            return
+        with self.lock:
+            self.entries[principal.username] = (principal, time.monotonic() + self.ttl)
+            self.entries.move_to_end(principal.username)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, username):
+        with self.lock:
+            self.entries.pop(username, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+principal_cache = PrincipalCache()
+
+# Users changed in a session are dropped from the cache once the change is committed, dropping them at
+# flush time would let a concurrent request cache the old row again before the commit
+INVALIDATE_KEY = 'principal_cache_invalidate'
+
+def remember_change(mapper, connection, target):
+    session = object_session(target)
+    if session is None:
+        principal_cache.clear()
+        return
+    usernames = session.info.setdefault(INVALIDATE_KEY, set())
+    if usernames is None:
+        # The whole cache is cleared on commit already
+        return
+    # A renamed user is cached under its old name
+    usernames.update(name for name in [target.username, *inspect(target).attrs.username.history.deleted] if name)
+
+for event_name in ('after_insert', 'after_update', 'after_delete'):
+    event.listen(User, event_name, remember_change)
+
+@event.listens_for(Session, 'do_orm_execute')
+def remember_bulk_change(orm_execute_state):
+    # update(User)/delete(User) statements don't go through the mapper events, they clear the whole cache
+    if (orm_execute_state.is_update or orm_execute_state.is_delete) and orm_execute_state.bind_mapper is not None \
+            and orm_execute_state.bind_mapper.class_ is User:
+        orm_execute_state.session.info[INVALIDATE_KEY] = None
+
+@event.listens_for(Session, 'after_commit')
+def invalidate_committed(session):
+    if INVALIDATE_KEY not in session.info:
+        return
+    usernames = session.info.pop(INVALIDATE_KEY)
+    if usernames is None:
+        principal_cache.clear()
+        return
+    for username in usernames:
+        principal_cache.invalidate(username)
+
+@event.listens_for(Session, 'after_rollback')
+def forget_changes(session):
+    session.info.pop(INVALIDATE_KEY, None)
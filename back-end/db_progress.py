@@ -0,0 +1,161 @@
+import threading
+import asyncio
+import json
+import time
+import os
+
+# Seconds between the writes of a running task's counters to running_tasks, live progress goes through the bus
+PROGRESS_CHECKPOINT_INTERVAL = float(os.getenv('PROGRESS_CHECKPOINT_INTERVAL', 30))
+# The same for workers in their own process, the API has no bus for their tasks and reads the counters from the DB.
+# Also how often the stream endpoint reads them
+PROGRESS_DB_INTERVAL = float(os.getenv('PROGRESS_DB_INTERVAL', 2))
+# Seconds between keep-alive comments on an idle stream, so proxies don't close it
+PROGRESS_KEEPALIVE_INTERVAL = float(os.getenv('PROGRESS_KEEPALIVE_INTERVAL', 15))
+
+class ProgressSubscriber:
+    # One stream listening to a task. The download thread merges deltas into `pending` and wakes the
+    # event loop once, so a fast task is coalesced into one message per loop turn instead of one per row
+    def __init__(self, loop):
+        self.loop = loop
+        self.event = asyncio.Event()
+        self.pending = {}
+        self.status = None
+        self.lock = threading.Lock()
+
+    def push(self, delta, status=None):
+        with self.lock:
+            wake = not self.pending and self.status is None
+            self.pending.update(delta)
+            if status is not None:
+                self.status = status
+        if wake:
+            self.loop.call_soon_threadsafe(self.event.set)
+
+    def take(self):
+        with self.lock:
+            delta, status = self.pending, self.status
+            self.pending, self.status = {}, None
+            self.event.clear()
+        return delta, status
+
+class ProgressBus:
+    # In-process state of the running download tasks. download_task publishes every counters update,
+    # /download_results reads the latest state from here and the stream endpoint gets the deltas pushed
+    def __init__(self):
+        self.tasks = {}
+        self.subscribers = {}
+        # Jobs of each task running in this process, shards of one task can run side by side
+        self.jobs = {}
+        self.lock = threading.Lock()
+
+    def start(self, task_id, job_id, **info):
+        # The first local job of a task creates its state, the others keep publishing into it
+        with self.lock:
+            if task_id not in self.tasks:
+                self.tasks[task_id] = {'status': 'running', 'processed_rows': 0, 'results': {}, **info}
+            self.jobs.setdefault(task_id, set()).add(job_id)
+
+    def get(self, task_id):
+        with self.lock:
+            state = self.tasks.get(task_id)
+            return dict(state, results=dict(state['results'])) if state else None
+
+    def publish(self, task_id, counters):
+        with self.lock:
+            state = self.tasks.get(task_id)
+            if state is None:
+                return
+            delta = {key: value for key, value in counters.items() if state['results'].get(key) != value}
+            if not delta:
+                return
+            state['results'].update(delta)
+            state['processed_rows'] = counters.get('processed_rows', state['processed_rows'])
+            subscribers = list(self.subscribers.get(task_id, ()))
+        for subscriber in subscribers:
+            subscriber.push(delta)
+
+    def finish(self, task_id, status='finished'):
+        # The final state is in the DB by now, the streams get the status and the task is dropped from the bus
+        with self.lock:
+            self.tasks.pop(task_id, None)
+            self.jobs.pop(task_id, None)
+            subscribers = self.subscribers.pop(task_id, [])
+        for subscriber in subscribers:
+            subscriber.push({}, status)
+
+    def release(self, task_id, job_id):
+        # A local job of the task is done. Once none is left the next job may run in another process,
+        # so this one stops answering for the task, its streams stay subscribed
+        with self.lock:
+            jobs = self.jobs.get(task_id)
+            if jobs is None or job_id not in jobs:
+                return
+            jobs.remove(job_id)
+            if not jobs:
+                self.jobs.pop(task_id)
+                self.tasks.pop(task_id, None)
+
+    def subscribe(self, task_id):
+        # Returns the subscriber and a snapshot taken under the same lock, so no delta falls between the two
+        subscriber = ProgressSubscriber(asyncio.get_running_loop())
+        with self.lock:
+            state = self.tasks.get(task_id)
+            if state is None:
+                return None, None
+            self.subscribers.setdefault(task_id, []).append(subscriber)
+            return subscriber, dict(state, results=dict(state['results']))
+
+    def unsubscribe(self, task_id, subscriber):
+        with self.lock:
+            subscribers = self.subscribers.get(task_id, [])
+            if subscriber in subscribers:
+                subscribers.remove(subscriber)
+
+    async def stream(self, task_id, snapshot, subscriber):
+        # Server-Sent Events: the snapshot first, then counter deltas, then the final status
+        try:
+            yield sse_message('snapshot', snapshot)
+            while True:
+                try:
+                    await asyncio.wait_for(subscriber.event.wait(), PROGRESS_KEEPALIVE_INTERVAL)
+                except asyncio.TimeoutError:
+                    yield ': keep-alive\n\n'
+                    continue
+                delta, status = subscriber.take()
+                if delta:
+                    yield sse_message('progress', delta)
+                if status is not None:
+                    yield sse_message(status, {'status': status})
+                    return
+        finally:
+            self.unsubscribe(task_id, subscriber)
+
+async def poll_stream(read_state, snapshot, interval=PROGRESS_DB_INTERVAL):
+    # Server-Sent Events for a task running in another process: the same messages as ProgressBus.stream,
+    # made from its state read every interval seconds. read_state returns the state or None once it is gone
+    yield sse_message('snapshot', snapshot)
+    results = snapshot['results']
+    last_message = time.monotonic()
+    while True:
+        await asyncio.sleep(interval)
+        state = await read_state()
+        if state is None:
+            return
+        delta = {key: value for key, value in state['results'].items() if results.get(key) != value}
+        if delta:
+            results = state['results']
+            last_message = time.monotonic()
+            yield sse_message('progress', delta)
+        elif time.monotonic() - last_message >= PROGRESS_KEEPALIVE_INTERVAL:
+            last_message = time.monotonic()
+            yield ': keep-alive\n\n'
+        if state['status'] not in ('queued', 'running'):
+            yield sse_message(state['status'], {'status': state['status']})
+            return
+
+def sse_message(event, data):
+    # Datetimes as ISO strings, the same as the JSON responses
+    data = json.dumps(data, default=lambda value: value.isoformat() if hasattr(value, 'isoformat') else str(value))
+    return f'event: {event}\ndata: {data}\n\n'
+
+progress_bus = ProgressBus()
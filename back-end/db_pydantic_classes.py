@@ -25,6 +25,17 @@ class RunningTask(BaseModel):
 
     results: str
 
+    engine: Optional[str] = None
+    concurrency: Optional[int] = None
+    max_per_host: Optional[int] = None
+    bandwidth_limit: Optional[int] = None
+    host_bandwidth_limit: Optional[int] = None
+    max_run_time: Optional[int] = None
+    max_files: Optional[int] = None
+    refresh: Optional[bool] = None
+    storage: Optional[str] = None
+    shards: Optional[int] = None
+
     class Config:
         orm_mode = True
 
@@ -42,16 +53,25 @@ class GRIPdfBase(BaseModel):
     download_status: str
     download_message: Optional[str] = None
     download_attempt_date: datetime
+    download_attempts: Optional[str] = None
 
     pdf_url: Optional[str] = None
     pdf_backup_url: Optional[str] = None
 
+    etag: Optional[str] = None
+    last_modified: Optional[str] = None
+    content_length: Optional[int] = None
+    content_hash: Optional[str] = None
+    source_url: Optional[str] = None
+
     class Config:
         orm_mode = True
 
 class PdfResponse(BaseModel):
     pdfs: List[GRIPdfBase]
-    total_pdfs: int
+    total_pdfs: Optional[int]  # None with count=none
+    total_estimated: bool = False  # total_pdfs comes from the DB's statistics
+    next_cursor: Optional[str] = None  # only in cursor mode, None on the last page
 
 class Filter(BaseModel):
     field: str
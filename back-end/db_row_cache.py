@@ -0,0 +1,191 @@
+from openpyxl import load_workbook
+from array import array
+from pathlib import Path
+import hashlib
+import locale
+import struct
+import csv
+import io
+import mmap
+import json
+import uuid
+import os
+
+# Cached sheets live next to the uploads, /list_files/pdf-urls/ only lists files so the folder stays hidden
+ROW_CACHE_FOLDER = '.row-cache'
+# Rows parsed before their offsets are flushed to the index file
+ROW_CACHE_BUILD_BATCH = 10000
+HASH_CHUNK_SIZE = 1024 * 1024
+# Every Nth CSV record gets its byte offset in the sidecar index, a seek parses at most N-1 records to reach start
+CSV_INDEX_STRIDE = int(os.getenv('CSV_INDEX_STRIDE', 1000))
+
+def file_digest(path):
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while chunk := f.read(HASH_CHUNK_SIZE):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+class SheetRowCache:
+    # An uploaded sheet parsed once into three files named after the sha256 of the sheet:
+    #   {digest}.rows  one JSON array of cell values per line
+    #   {digest}.idx   the byte offset of every line as unsigned 64 bit ints, so row n is at idx[n]
+    #   {digest}.json  headers and row count, written last so a half built cache is never used
+    # Later tasks seek straight to start_row instead of walking the sheet XML from the top with openpyxl
+    def __init__(self, sheet_path, cache_folder=None):
+        self.sheet_path = Path(sheet_path)
+        self.cache_folder = Path(cache_folder) if cache_folder else self.sheet_path.parent / ROW_CACHE_FOLDER
+        self.meta = None
+
+    def digest(self):
+        return file_digest(self.sheet_path)
+
+    def paths(self, digest):
+        base = f'{self.cache_folder}/{digest}'
+        return f'{base}.rows', f'{base}.idx', f'{base}.json'
+
+    def load(self):
+        # Build the cache if this version of the sheet has none yet, returns its metadata
+        if self.meta is not None:
+            return self.meta
+        digest = self.digest()
+        rows_path, idx_path, meta_path = self.paths(digest)
+        if not os.path.exists(meta_path):
+            self.build(digest)
+        with open(meta_path, 'r') as f:
+            self.meta = json.load(f)
+        self.meta['digest'] = digest
+        return self.meta
+
+    def build(self, digest=None):
+        digest = digest if digest else self.digest()
+        os.makedirs(self.cache_folder, exist_ok=True)
+        rows_path, idx_path, meta_path = self.paths(digest)
+        # Write under temporary names and rename into place, two tasks building the same sheet don't clash
+        tmp = f'.{uuid.uuid4().hex}.tmp'
+        workbook = load_workbook(filename=self.sheet_path, read_only=True)
+        try:
+            worksheet = workbook.active
+            values = worksheet.iter_rows(values_only=True)
+            headers = list(next(values, ()))
+            count = 0
+            offsets = array('Q')
+            with open(rows_path + tmp, 'wb') as rows_file, open(idx_path + tmp, 'wb') as idx_file:
+                for row in values:
+                    offsets.append(rows_file.tell())
+                    # Dates are stored the way the DB driver would render them into the string columns
+                    rows_file.write(json.dumps(row, default=str).encode() + b'\n')
+                    count += 1
+                    if len(offsets) >= ROW_CACHE_BUILD_BATCH:
+                        offsets.tofile(idx_file)
+                        offsets = array('Q')
+                offsets.tofile(idx_file)
+        finally:
+            workbook.close()
+        with open(meta_path + tmp, 'w') as f:
+            json.dump({'sheet': self.sheet_path.name, 'headers': headers, 'rows': count}, f)
+        os.replace(rows_path + tmp, rows_path)
+        os.replace(idx_path + tmp, idx_path)
+        os.replace(meta_path + tmp, meta_path)
+        self.remove_stale(digest)
+
+    def remove_stale(self, digest):
+        # Drop the caches of earlier uploads under the same file name
+        for entry in os.scandir(self.cache_folder):
+            if not entry.name.endswith('.json') or entry.name.startswith(digest):
+                continue
+            try:
+                with open(entry.path, 'r') as f:
+                    sheet = json.load(f).get('sheet')
+            except (OSError, ValueError):
+                continue
+            if sheet == self.sheet_path.name:
+                for path in self.paths(entry.name[:-len('.json')]):
+                    if os.path.exists(path):
+                        os.remove(path)
+
+    def rows(self, start=0, nrows=None):
+        meta = self.load()
+        headers = meta['headers']
+        stop = min(meta['rows'], start + nrows) if nrows else meta['rows']
+        if start >= stop:
+            return
+        rows_path, idx_path, _ = self.paths(meta['digest'])
+        with open(idx_path, 'rb') as idx_file:
+            with mmap.mmap(idx_file.fileno(), 0, access=mmap.ACCESS_READ) as idx:
+                offset, = struct.unpack_from('Q', idx, start * 8)
+        with open(rows_path, 'rb') as rows_file:
+            rows_file.seek(offset)
+            for _ in range(stop - start):
+                yield dict(zip(headers, json.loads(rows_file.readline())))
+
+class CsvOffsetIndex:
+    # Sidecar for a CSV URL list with the byte offset of every stride-th record, named after the sha256 of the
+    # file so an edited list gets a new one. Offsets are taken after whole records, quoted fields that span
+    # lines are handled by the csv module, so a seek always lands on the start of a record
+    def __init__(self, csv_path, cache_folder=None, stride=CSV_INDEX_STRIDE):
+        self.csv_path = Path(csv_path)
+        self.cache_folder = Path(cache_folder) if cache_folder else self.csv_path.parent / ROW_CACHE_FOLDER
+        self.stride = stride
+        # Same encoding open() uses by default, the file is read in binary to know the byte offsets
+        self.encoding = locale.getpreferredencoding(False)
+        self.offsets = None
+
+    def path(self, digest):
+        return f'{self.cache_folder}/{digest}.{self.stride}.csvidx'
+
+    def load(self):
+        if self.offsets is not None:
+            return self.offsets
+        path = self.path(file_digest(self.csv_path))
+        if not os.path.exists(path):
+            self.build(path)
+        self.offsets = array('Q')
+        with open(path, 'rb') as f:
+            self.offsets.frombytes(f.read())
+        return self.offsets
+
+    def build(self, path):
+        os.makedirs(self.cache_folder, exist_ok=True)
+        offsets = array('Q')
+        with open(self.csv_path, 'rb') as f:
+            position = 0
+            def lines():
+                nonlocal position
+                for line in f:
+                    position += len(line)
+                    yield line.decode(self.encoding)
+            # csv.reader pulls exactly the lines of one record, so position is the end of the last record read
+            reader = csv.reader(lines())
+            next(reader, None)
+            i = 0
+            record_start = position
+            for _ in reader:
+                if i % self.stride == 0:
+                    offsets.append(record_start)
+                record_start = position
+                i += 1
+        tmp = f'{path}.{uuid.uuid4().hex}.tmp'
+        with open(tmp, 'wb') as f:
+            offsets.tofile(f)
+        os.replace(tmp, path)
+
+    def rows(self, start=0, nrows=None):
+        offsets = self.load()
+        if not offsets:
+            return
+        block = min(start // self.stride, len(offsets) - 1)
+        with open(self.csv_path, 'rb') as binary:
+            text = io.TextIOWrapper(binary, encoding=self.encoding, newline='')
+            headers = next(csv.reader(text))
+            # The wrapper reads ahead of the header, so it is detached and a new one starts at the offset
+            text.detach()
+            binary.seek(offsets[block])
+            reader = csv.reader(io.TextIOWrapper(binary, encoding=self.encoding, newline=''))
+            skip = start - block * self.stride
+            for i, row in enumerate(reader):
+                if i < skip:
+                    continue
+                if nrows and i >= skip + nrows:
+                    break
+                yield dict(zip(headers, row))
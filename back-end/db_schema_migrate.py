@@ -0,0 +1,69 @@
+from sqlalchemy import create_engine, inspect, update, func, String
+from db_classes import GRIPdf
+from db_connect import SyncDatabaseConnect
+import argparse
+
+def migrate_gripdf_schema(dry_run=False):
+    # Brings a GRIPdfs table created with the old unbounded Text columns to the bounded columns and indexes
+    # of the model. create_all only creates missing tables, so a populated database needs this once.
+    # Values longer than the new columns are cut first, MySQL refuses to shorten a column over them otherwise.
+    # Running it again only does what is still missing, SQLite keeps its TEXT columns and only gets the values checked
+    engine = create_engine(SyncDatabaseConnect().get_db_url())
+    table = GRIPdf.__table__
+    inspector = inspect(engine)
+    existing_columns = {column['name']: column for column in inspector.get_columns(table.name)}
+    existing_indexes = {index['name'] for index in inspector.get_indexes(table.name)}
+    mysql = engine.dialect.name == 'mysql'
+    length_of = func.char_length if mysql else func.length
+
+    # Columns the model bounds that are unbounded or longer in the database
+    bounded = []
+    for column in table.columns:
+        length = getattr(column.type, 'length', None)
+        current = existing_columns.get(column.name)
+        if not isinstance(column.type, String) or length is None or current is None or column.unique:
+            continue
+        if getattr(current['type'], 'length', None) != length:
+            bounded.append(column)
+    missing_indexes = [index for index in table.indexes if index.name not in existing_indexes]
+
+    counters = {'columns': [column.name for column in bounded], 'indexes': [index.name for index in missing_indexes], 'values_cut': 0}
+    if dry_run:
+        engine.dispose()
+        return counters
+
+    with engine.begin() as connection:
+        for column in bounded:
+            length = column.type.length
+            result = connection.execute(
+                update(table).where(length_of(column) > length).values({column.name: func.substr(column, 1, length)})
+            )
+            counters['values_cut'] += result.rowcount
+
+    if mysql and (bounded or missing_indexes):
+        # One ALTER TABLE, so MySQL rebuilds the table once for all the columns and indexes
+        preparer = engine.dialect.identifier_preparer
+        changes = [
+            f"MODIFY {preparer.quote(column.name)} {column.type.compile(dialect=engine.dialect)} {'NULL' if column.nullable else 'NOT NULL'}"
+            for column in bounded
+        ]
+        changes += [
+            f"ADD INDEX {preparer.quote(index.name)} ({', '.join(preparer.quote(column.name) for column in index.columns)})"
+            for index in missing_indexes
+        ]
+        with engine.begin() as connection:
+            connection.exec_driver_sql(f"ALTER TABLE {preparer.quote(table.name)} {', '.join(changes)}")
+    else:
+        # SQLite doesn't enforce VARCHAR lengths, the indexes are all it needs
+        with engine.begin() as connection:
+            for index in missing_indexes:
+                index.create(bind=connection)
+    engine.dispose()
+    return counters
+
+if __name__ == '__main__':
+    # python db_schema_migrate.py --dry-run to see what would change, then without it to apply it
+    parser = argparse.ArgumentParser(description='Bound and index the GRIPdfs filter and sort columns of an existing database')
+    parser.add_argument('--dry-run', action='store_true')
+    args = parser.parse_args()
+    print(migrate_gripdf_schema(args.dry_run))
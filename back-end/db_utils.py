@@ -3,7 +3,7 @@ from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
 from db_classes import *
 from db_connect import SyncDatabaseConnect
-from sqlalchemy import inspect
+from sqlalchemy import inspect, text
 from werkzeug.security import generate_password_hash
 from openpyxl import Workbook
 from dotenv import load_dotenv
@@ -121,6 +121,19 @@ class DatabaseUtils:
         
     def create_tables(self):
         from db_classes import Base
-        # Create all tables in the database
-        if not inspect(self.engine).has_table('users'):
-            Base.metadata.create_all(bind=self.engine)
+        # Create the missing tables in the database
+        Base.metadata.create_all(bind=self.engine)
+        self.upgrade_tables()
+
+    def upgrade_tables(self):
+        from db_classes import Base
+        # create_all leaves existing tables alone, so add the nullable columns the models gained since
+        inspector = inspect(self.engine)
+        with self.engine.begin() as connection:
+            for table in Base.metadata.sorted_tables:
+                existing_columns = {column['name'] for column in inspector.get_columns(table.name)}
+                for column in table.columns:
+                    if column.name in existing_columns or not column.nullable:
+                        continue
+                    column_type = column.type.compile(dialect=self.engine.dialect)
+                    connection.execute(text(f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}"))
@@ -1,14 +1,20 @@
 from fastapi import FastAPI, HTTPException, status, Depends, UploadFile, File, BackgroundTasks
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse, FileResponse
+from fastapi.responses import JSONResponse, FileResponse, StreamingResponse
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm, APIKeyHeader
 from fastapi.staticfiles import StaticFiles
 
 from db_pydantic_classes import *
 from db_classes import *
-from db_connect import AsyncDatabaseConnect, SyncDatabaseConnect
+from db_connect import open_shared, close_shared, shared_stats
 from db_utils import DatabaseUtils
-from db_download_manager import DownloadManager
+from db_download_manager import DOWNLOAD_ENGINES, DOWNLOAD_SOURCES, FAILED_ROWS_FILE
+from db_download_worker import enqueue_task, split_rows, split_limit, start_inprocess_workers, cancel_local, DOWNLOAD_WORKER_MODE
+from db_pdf_storage import PdfStorage, STORAGE_MODES
+from db_row_cache import SheetRowCache
+from db_progress import progress_bus, poll_stream
+from db_principal_cache import principal_cache, Principal, AUTH_TRUST_CLAIMS_SECONDS
+from db_count_cache import count_pdfs, COUNT_MODES
 
 from sqlalchemy.future import select
 from sqlalchemy import update
@@ -28,6 +34,7 @@ from os.path import isfile, join, exists
 import time
 import uuid
 
+from contextlib import asynccontextmanager
 from dotenv import load_dotenv
 
 import uvicorn
@@ -43,12 +50,26 @@ ACCESS_TOKEN_EXPIRE_MINUTES = int(os.getenv('ACCESS_TOKEN_EXPIRE_MINUTES'))
 
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
+# For endpoints that also take the token as a query parameter
+optional_oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token", auto_error=False)
 API_KEY_NAME = "User_Authentication"
 api_key_header = APIKeyHeader(name=API_KEY_NAME, auto_error=True)
 directory = "pdf-files"
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app):
+    # One async and one sync engine for the life of the app, requests only check a connection out of their pools
+    open_shared()
+    # Without separate worker processes the API claims the queued jobs itself, in a background thread
+    if DOWNLOAD_WORKER_MODE == "inprocess":
+        start_inprocess_workers()
+    yield
+    await close_shared()
+
+app = FastAPI(lifespan=lifespan)
 db_utils = DatabaseUtils()
+# Finds downloaded files in the flat or the sharded layout
+pdf_storage = PdfStorage(directory)
 
 # Check if the directory exists
 if not os.path.exists(directory):
@@ -74,20 +95,14 @@ app.add_middleware(
 )
 
 async def get_db():
-    db_connect = AsyncDatabaseConnect()
-    session = db_connect.get_new_session()
-    try:
+    db_connect, _ = open_shared()
+    async with db_connect.new_session() as session:
         yield session
-    finally:
-        await db_connect.close()
 
 def get_sync_db():
-    db_connect =  SyncDatabaseConnect()
-    session = db_connect.get_new_session()
-    try:
+    _, db_connect = open_shared()
+    with db_connect.new_session() as session:
         yield session
-    finally:
-        db_connect.close()
 
 @app.exception_handler(HTTPException)
 async def http_exception_handler(request, exc):
@@ -117,11 +132,21 @@ def create_access_token(data: dict, expires_delta: timedelta = None):
         expire = datetime.now() + expires_delta
     else:
         expire = datetime.now() + timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
-    to_encode.update({"exp": expire})
+    # iat in epoch seconds, get_current_user trusts the claims of fresh tokens when AUTH_TRUST_CLAIMS_SECONDS is set
+    to_encode.update({"exp": expire, "iat": int(time.time())})
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
 async def get_current_user(token: str = Depends(oauth2_scheme), session: AsyncSession = Depends(get_db)):
+    return await user_from_token(token, session)
+
+async def get_current_stream_user(token: Optional[str] = Depends(optional_oauth2_scheme), access_token: Optional[str] = None, session: AsyncSession = Depends(get_db)):
+    # EventSource can't send an Authorization header, so the event streams also take the token as ?access_token=
+    if not token and not access_token:
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Not authenticated", headers={"WWW-Authenticate": "Bearer"})
+    return await user_from_token(token or access_token, session)
+
+async def user_from_token(token, session):
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
@@ -135,16 +160,29 @@ async def get_current_user(token: str = Depends(oauth2_scheme), session: AsyncSe
         token_data = TokenData(username=username)
     except JWTError:
         raise credentials_exception
+    # The signature covers is_admin, so a token issued moments ago needs no lookup at all
+    issued_at = payload.get("iat")
+    if AUTH_TRUST_CLAIMS_SECONDS > 0 and issued_at is not None and "is_admin" in payload and time.time() - issued_at <= AUTH_TRUST_CLAIMS_SECONDS:
+        return Principal(token_data.username, payload["is_admin"])
+    # Otherwise the user is loaded once and cached, the cache drops users that are changed through the ORM
+    principal = principal_cache.get(token_data.username)
+    if principal is not None:
+        return principal
     user = (await session.execute(select(User).where(User.username == token_data.username))).scalar_one_or_none()
     if user is None:
         raise credentials_exception
-    return user
+    principal = Principal.from_user(user)
+    principal_cache.put(principal)
+    return principal
 
 async def get_current_admin_user(current_user: User = Depends(get_current_user)):
     if not current_user.is_admin == "True":
         raise HTTPException(status_code=403, detail="User is not an admin")
     return current_user
 
+async def get_current_stream_admin_user(current_user: User = Depends(get_current_stream_user)):
+    return await get_current_admin_user(current_user)
+
 @app.post("/users/create", response_model=UserResposne)
 async def create_user(user: UserBase, session: AsyncSession = Depends(get_db)):
     existing_user = await User.check_if_exists(session, field="username", value=user.username)
@@ -174,24 +212,39 @@ async def create_admin_user(user: UserAdmin, current_user: User = Depends(get_cu
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.get("/pdfs", response_model=PdfResponse)
-async def get_pdfs(page: Optional[int] = 1, page_size: Optional[int] = 100, filters: Optional[str] = None, sort_by: Optional[str] = None, sort_order: Optional[str] = 'asc', session: AsyncSession = Depends(get_db)):
+async def get_pdfs(page: Optional[int] = 1, page_size: Optional[int] = 100, filters: Optional[str] = None, sort_by: Optional[str] = None, sort_order: Optional[str] = 'asc', cursor: Optional[str] = None, count: str = "exact", session: AsyncSession = Depends(get_db)):
+    # With cursor set the pages follow next_cursor instead of page numbers, an empty cursor is the first page.
+    # count=exact gives a cached total, estimate the DB's guess for large tables and none skips it
+    if count not in COUNT_MODES:
+        raise HTTPException(status_code=400, detail=f"Unsupported count mode: {count}")
     if page < 1:
         raise HTTPException(status_code=400, detail="Page number must be at least 1")
+    if page_size < 1:
+        raise HTTPException(status_code=400, detail="Page size must be at least 1")
     try:
         filters_dict = json.loads(filters) if filters else None
     except JSONDecodeError:
         raise HTTPException(status_code=400, detail="Invalid JSON format in filters")
+    # Only indexed columns, any other filter or sort would scan the whole table
+    if sort_by and sort_by != "null" and sort_by not in GRIPdf.QUERY_FIELDS:
+        raise HTTPException(status_code=400, detail=f"Can't sort by {sort_by}, use one of: {', '.join(GRIPdf.QUERY_FIELDS)}")
     if filters_dict:
         for key, value in filters_dict.items():
             if key is None or key == "null":
                 raise HTTPException(status_code=400, detail=f"Filter key cannot be None")
             if value is None:
                 raise HTTPException(status_code=400, detail=f"Filter value for {key} cannot be None")
+            if key not in GRIPdf.QUERY_FIELDS:
+                raise HTTPException(status_code=400, detail=f"Can't filter on {key}, use one of: {', '.join(GRIPdf.QUERY_FIELDS)}")
         filters_dict = {key: {"field": key, "value": value} for key, value in filters_dict.items()}
-    result = await GRIPdf.get_range(session, page, page_size, filters_dict, sort_by, sort_order)
-    total_pdfs = await GRIPdf.get_count(session, filters_dict)
+    next_cursor = None
+    if cursor is not None:
+        result, next_cursor = await GRIPdf.get_keyset(session, page_size, filters_dict, sort_by, sort_order, cursor)
+    else:
+        result = await GRIPdf.get_range(session, page, page_size, filters_dict, sort_by, sort_order)
+    total_pdfs, total_estimated = await count_pdfs(session, filters_dict, count)
     if result:
-        return {"pdfs": result, "total_pdfs": total_pdfs}
+        return {"pdfs": result, "total_pdfs": total_pdfs, "total_estimated": total_estimated, "next_cursor": next_cursor}
     else:
         raise HTTPException(status_code=404, detail="No PDFs found in the given range")
     
@@ -200,19 +253,20 @@ async def get_pdf_file(brnumber: str, response_type: str = "download", current_u
     result = await GRIPdf.get_by_brnumber(session, brnumber)
     if result:
         if response_type == "local":
-            file_path = f"{result.file_folder}/{result.file_name}"
+            file_path = pdf_storage.locate(result.file_folder, result.file_name) or f"{result.file_folder}/{result.file_name}"
             return f"file://{file_path}"
         elif response_type == "link":
             return {"pdf_url": result.pdf_url, "pdf_backup_url": result.pdf_backup_url}
         elif response_type == "download":
             if not result.file_name:
                 raise HTTPException(status_code=404, detail="PDF file not found")
-            if not os.path.exists(f"{result.file_folder}/{result.file_name}"):
+            file_path = pdf_storage.locate(result.file_folder, result.file_name)
+            if not file_path:
                 raise HTTPException(status_code=404, detail="PDF file not found")
             if not result.download_status == "TRUE":
                 raise HTTPException(status_code=404, detail="PDF file not downloaded")
             return FileResponse(
-                path=f"{result.file_folder}/{result.file_name}",
+                path=file_path,
                 media_type='application/pdf',
                 headers={"Content-Disposition": f"attachment; filename={result.file_name}"}
             )
@@ -262,7 +316,7 @@ async def download_gripdfs_csv(file_name: str = "metadata_summary.csv", current_
     )
 
 @app.post("/upload_files/pdf-urls/{overwrite}")
-async def upload_files(files: List[UploadFile] = File(...), overwrite: bool = False, current_user: User = Depends(get_current_admin_user)):
+async def upload_files(background_tasks: BackgroundTasks, files: List[UploadFile] = File(...), overwrite: bool = False, current_user: User = Depends(get_current_admin_user)):
     for file in files:
         file_extension = file.filename.split('.')[-1]
         if file_extension not in ['xlsx', 'xls']:
@@ -274,6 +328,9 @@ async def upload_files(files: List[UploadFile] = File(...), overwrite: bool = Fa
         
         with open(file_location, "wb+") as file_object:
             file_object.write(file.file.read())
+        # Parse the sheet into its row cache now, so the first download task doesn't have to
+        if file_extension == 'xlsx':
+            background_tasks.add_task(SheetRowCache(file_location).build)
     return {"detail": "File uploaded successfully"}
 
 @app.get("/list_files/pdf-urls/")
@@ -283,7 +340,8 @@ async def list_files(current_user: User = Depends(get_current_admin_user)):
 
 @app.get("/list_files/pdf-files/")
 async def list_files(current_user: User = Depends(get_current_admin_user)):
-    files = [f for f in listdir('pdf-files') if isfile(join('pdf-files', f))]
+    # Includes the files in the shard subfolders
+    files = [file_name for _, file_name in pdf_storage.list_files()]
     return files
 
 @app.post("/cancel_running_tasks/{task_id}")
@@ -292,100 +350,164 @@ async def cancel_running_task(task_id: str, current_user: User = Depends(get_cur
     task = result.scalars().first()
     if not task:
         return {"message": "No such task"}
-    if task.status == "running":
+    if task.status in ("queued", "running"):
         stmt = (
             update(RunningTask).
             where(RunningTask.task_id == task_id).
             values(status="cancelled")
         )
         await session.execute(stmt)
+        # Queued jobs are never claimed, a worker running the job loses it at its next heartbeat
+        await session.execute(update(TaskJob).where(TaskJob.task_id == task_id, TaskJob.status.in_(["queued", "running"])).values(status="cancelled"))
         await session.commit()
+        # Stop the downloads right away when the task runs in this process
+        cancel_local(task_id)
         return {"message": "Task cancelled"}
     else:
         return {"message": "Task is already finished"}
 
-#Have use sync session here, async session freezes the api
-def download_task(dm: DownloadManager, start_row: int, num_rows: int, task_id: str, session: Session = Depends(get_sync_db)):
-    last_commit_time = time.time()
-    result = None  # Define result here
-
-    def download_and_update():
-        nonlocal last_commit_time, result  # Add result here
-        for result in dm.start_download(start_row, num_rows):
-            # Update the task with the latest result
-            result_json = json.dumps(result)
-            end_time = datetime.now()
-            stmt = (
-                update(RunningTask).
-                where(RunningTask.task_id == task_id).
-                values(status="running", results=result_json, end_time=end_time, processed_rows=result['processed_rows'])
-            )
-            current_time = time.time()
-            if current_time - last_commit_time >= 1:  # Check if at least 1 second has passed
-                session.execute(stmt)
-                session.commit()
-                last_commit_time = current_time  # Update the last commit time
-
-    download_and_update()
-
-    # Mark the task as finished
-    end_time = datetime.now()
-    result_json = json.dumps(result)  # Use result here
-    stmt = (
-        update(RunningTask).
-        where(RunningTask.task_id == task_id).
-        values(status="finished", results=result_json, end_time=end_time, processed_rows=result['processed_rows'])
-    )
-    session.execute(stmt)
-    session.commit()
-
 #Have use sync session here, async session freezes the api
 @app.post("/start_download_manager/")
-async def start_download(background_tasks: BackgroundTasks, start_row: Optional[int] = None, num_rows: Optional[int] = None, filename: str = "GRI_2017_2020.xlsx",  current_user: User = Depends(get_current_admin_user), session: Session = Depends(get_sync_db)):
+async def start_download(start_row: Optional[int] = None, num_rows: Optional[int] = None, filename: str = "GRI_2017_2020.xlsx", engine: str = "thread", concurrency: Optional[int] = None, max_per_host: Optional[int] = None, bandwidth_limit: Optional[int] = None, host_bandwidth_limit: Optional[int] = None, max_run_time: Optional[int] = None, max_files: Optional[int] = None, refresh: bool = False, storage: str = "name", shards: int = 1, source: str = "sheet", message_pattern: Optional[str] = None, attempted_before: Optional[datetime] = None, current_user: User = Depends(get_current_admin_user), session: Session = Depends(get_sync_db)):
     if not current_user.is_admin == "True":
         raise HTTPException(status_code=403, detail="User is not an admin")
-    
-    # Get the file extension
-    _, file_extension = os.path.splitext(filename)
 
-    # Check if the file is in a supported format
-    if file_extension not in ['.csv', '.xlsx', '.xlsm', '.xltx', '.xltm']:
-        raise HTTPException(status_code=400, detail=f"Unsupported file format: {file_extension}")
+    # Check if the download engine is supported
+    if engine not in DOWNLOAD_ENGINES:
+        raise HTTPException(status_code=400, detail=f"Unsupported download engine: {engine}")
+    if concurrency is not None and concurrency < 1:
+        raise HTTPException(status_code=400, detail="Concurrency must be at least 1")
+    if max_per_host is not None and max_per_host < 1:
+        raise HTTPException(status_code=400, detail="Max connections per host must be at least 1")
+    if storage not in STORAGE_MODES:
+        raise HTTPException(status_code=400, detail=f"Unsupported storage mode: {storage}")
+    if shards < 1:
+        raise HTTPException(status_code=400, detail="Shards must be at least 1")
+    if shards > 1 and not num_rows:
+        raise HTTPException(status_code=400, detail="num_rows is required to split a task into shards")
+    if source not in DOWNLOAD_SOURCES:
+        raise HTTPException(status_code=400, detail=f"Unsupported download source: {source}")
+    if source == "failed" and shards > 1:
+        raise HTTPException(status_code=400, detail="Retrying failed rows can't be split into shards")
+
+    # Check the limits, bandwidth is in bytes/second and run time in seconds
+    limits = {"bandwidth_limit": bandwidth_limit, "host_bandwidth_limit": host_bandwidth_limit, "max_run_time": max_run_time, "max_files": max_files}
+    for key, value in limits.items():
+        if value is not None and value < 1:
+            raise HTTPException(status_code=400, detail=f"{key} must be at least 1")
+    # The bandwidth is shared out over the shards, a shard left with 0 bytes/second would run unlimited
+    for key in ("bandwidth_limit", "host_bandwidth_limit"):
+        if limits[key] is not None and limits[key] < shards:
+            raise HTTPException(status_code=400, detail=f"{key} must be at least 1 per shard")
+    options = {"engine": engine, "concurrency": concurrency, "max_per_host": max_per_host, "refresh": refresh, "storage": storage, **limits}
+
+    source_options = {}
+    if source == "failed":
+        # The failed rows of the GRIPdfs table are retried instead of a sheet's rows, num_rows caps how many.
+        # Only rows attempted before the task started, so a resumed task skips the ones it retried already
+        filename = FAILED_ROWS_FILE
+        start_row = 0
+        if attempted_before and attempted_before.tzinfo:
+            attempted_before = attempted_before.astimezone().replace(tzinfo=None)
+        attempted_before = min(attempted_before, datetime.now()) if attempted_before else datetime.now()
+        source_options = {"source": source, "message_pattern": message_pattern, "attempted_before": attempted_before.isoformat()}
+    else:
+        # Get the file extension
+        _, file_extension = os.path.splitext(filename)
+
+        # Check if the file is in a supported format
+        if file_extension not in ['.csv', '.xlsx', '.xlsm', '.xltx', '.xltm']:
+            raise HTTPException(status_code=400, detail=f"Unsupported file format: {file_extension}")
 
-    # Check if there's already a running task with the same filename
-    running_task = session.query(RunningTask).filter(RunningTask.running_file == filename, RunningTask.status == "running").first()
-    if running_task:
+        # The worker reads the file, so check it exists before queueing
+        if not exists(f"pdf-urls/{filename}"):
+            raise HTTPException(status_code=404, detail=f"File {filename} not found")
+
+    # Check if there's already a queued or running task with the same filename
+    if active_task(session, filename):
         raise HTTPException(status_code=400, detail="Task already running")
 
     try:
-        db_dm = DownloadManager(folder='pdf-files', file_with_urls=f'pdf-urls\\{filename}')
         task_id = str(uuid.uuid4())
         new_task = RunningTask(
             task_id=task_id,
             name="Download Task",
             running_file=filename,
-            status="running",
+            status="queued",
             start_time=datetime.now(),
             start_row=start_row if start_row else 0,
-            num_rows=num_rows if num_rows else 0
+            num_rows=num_rows if num_rows else 0,
+            **options
         )
         session.add(new_task)
+        # Only queue the jobs here, download workers claim them and run them outside the request handling.
+        # A sharded task gets one job per row range, any number of workers can run them side by side
+        row_ranges = split_rows(new_task.start_row, new_task.num_rows, shards) if shards > 1 else [(new_task.start_row, new_task.num_rows)]
+        new_task.shards = len(row_ranges)
+        # The limits hold for the whole task: max_files and the bandwidth are shared out over the shards, and all
+        # of them stop at one deadline taken from the task's start instead of each running max_run_time on its own
+        shard_limits = {key: split_limit(limits[key], len(row_ranges)) for key in ("bandwidth_limit", "host_bandwidth_limit", "max_files")}
+        deadline = new_task.start_time.timestamp() + max_run_time if max_run_time else None
+        for shard, (shard_start, shard_rows) in enumerate(row_ranges):
+            shard_options = {**options, **{key: values[shard] for key, values in shard_limits.items()}, "deadline": deadline}
+            enqueue_task(session, task_id, {"filename": filename, "start_row": shard_start, "num_rows": shard_rows, **shard_options, **source_options}, shard)
         session.commit()
-        background_tasks.add_task(download_task, db_dm, start_row if start_row else 0, num_rows if num_rows else 0, task_id, session)
-        return {"message": "Download started", "task_id": task_id}
+        return {"message": "Download queued", "task_id": task_id}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+def active_task(session, filename):
+    # The queued or running task of a file. A task left running without a job that is queued or leased, like one
+    # from before the task_jobs queue or one whose last worker died before writing its status, is stale and is failed
+    for task in session.query(RunningTask).filter(RunningTask.running_file == filename, RunningTask.status.in_(["queued", "running"])).all():
+        if TaskJob.task_statuses(session, task.task_id) & {"queued", "running"}:
+            return task
+        task.status = "failed"
+        task.end_time = datetime.now()
+        session.commit()
+    return None
+
+#Have use sync session here, async session freezes the api
+@app.post("/resume_task/{task_id}")
+async def resume_task(task_id: str, current_user: User = Depends(get_current_admin_user), session: Session = Depends(get_sync_db)):
+    # Queue the failed and cancelled jobs of a task again, each continues from the rows its checkpoint has done.
+    # Jobs whose worker died are resumed by the next worker on their own once the lease runs out
+    task = session.get(RunningTask, task_id)
+    if not task:
+        raise HTTPException(status_code=404, detail="No such task")
+    # Also the task itself, unless it is stale
+    if active_task(session, task.running_file):
+        raise HTTPException(status_code=400, detail="Task already running")
+    if not TaskJob.requeue(session, task_id):
+        session.rollback()
+        raise HTTPException(status_code=400, detail="Task has no failed or cancelled jobs to resume")
+    task.status = "queued"
+    session.commit()
+    return {"message": "Download queued", "task_id": task_id}
+
 @app.get("/download_results/{task_id}")
 async def get_download_results(task_id: str, session: AsyncSession = Depends(get_db), current_user: User = Depends(get_current_admin_user)):
+    # Tasks running in this process are answered from the progress bus without touching the DB
+    state = progress_bus.get(task_id)
+    if state:
+        return {
+            "status": state["status"],
+            "start_time": state["start_time"],
+            "running_time": datetime.now() - state["start_time"],
+            "start_row": state["start_row"],
+            "num_rows": state["num_rows"],
+            "processed_rows": state["processed_rows"],
+            "running_file": state["running_file"],
+            "results": state["results"]
+        }
     result = await session.execute(select(RunningTask).where(RunningTask.task_id == task_id))
     task = result.scalars().first()
     if not task:
         return {"message": "No such task"}
-    if task.status == "running":
+    if task.status in ("queued", "running"):
         results = task.results
         return {
-            "status": "running",
+            "status": task.status,
             "start_time": task.start_time,
             "running_time": datetime.now() - task.start_time,
             "start_row": task.start_row,
@@ -394,13 +516,13 @@ async def get_download_results(task_id: str, session: AsyncSession = Depends(get
             "running_file": task.running_file,  # Include the filename of the running task
             "results": json.loads(results) if results else []  # Check if results is not None before calling json.loads
         }
-    elif task.status == "finished":
+    elif task.status in ("finished", "cancelled", "failed"):
         results = task.results
         await session.commit()
         return {
-            "status": "finished",   
+            "status": task.status,
             "start_time": task.start_time,
-            "running_time": task.end_time - task.start_time,
+            "running_time": (task.end_time or task.start_time) - task.start_time,
             "start_row": task.start_row,
             "num_rows": task.num_rows,
             "processed_rows": task.processed_rows,
@@ -408,6 +530,50 @@ async def get_download_results(task_id: str, session: AsyncSession = Depends(get
             "results": json.loads(results) if results else []  # Check if results is not None before calling json.loads
         }
 
+async def read_task_progress(task_id):
+    # State of a task in the shape of the bus, from the bus when a job of it runs here and from running_tasks otherwise
+    state = progress_bus.get(task_id)
+    if state:
+        return state
+    db_connect, _ = open_shared()
+    async with db_connect.new_session() as session:
+        task = await session.get(RunningTask, task_id)
+    if task is None:
+        return None
+    return {
+        "status": task.status,
+        "start_time": task.start_time,
+        "start_row": task.start_row,
+        "num_rows": task.num_rows,
+        "processed_rows": task.processed_rows,
+        "running_file": task.running_file,
+        "results": json.loads(task.results) if task.results else {}
+    }
+
+@app.get("/download_results/{task_id}/stream")
+async def stream_download_results(task_id: str, current_user: User = Depends(get_current_stream_admin_user)):
+    # Server-Sent Events with the counters of a running task: a snapshot, then deltas as they happen
+    subscriber, snapshot = progress_bus.subscribe(task_id)
+    if subscriber is not None:
+        stream = progress_bus.stream(task_id, snapshot, subscriber)
+    else:
+        # The task runs in a worker process, its counters are read back as the worker checkpoints them
+        snapshot = await read_task_progress(task_id)
+        if snapshot is None or snapshot["status"] not in ("queued", "running"):
+            raise HTTPException(status_code=404, detail="Task is not running, use /download_results/ for its results")
+        stream = poll_stream(lambda: read_task_progress(task_id), snapshot)
+    snapshot["running_time"] = (datetime.now() - snapshot["start_time"]).total_seconds()
+    return StreamingResponse(
+        stream,
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@app.get("/db_pool_stats/")
+async def get_db_pool_stats(current_user: User = Depends(get_current_admin_user)):
+    # Checked out, idle and overflow connections of the shared engines
+    return shared_stats()
+
 #db_utils.reset_and_setup_db()
 db_utils.setup_db()
 #db_utils.extract_table_as_csv(User, "users.csv")
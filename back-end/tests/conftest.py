@@ -0,0 +1,5 @@
+import sys
+import os
+
+# The back-end modules are imported flat, the same as main.py does
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,54 @@
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+from sqlalchemy import create_engine
+import functools
+import threading
+import os
+import pytest
+
+@pytest.fixture
+def pdf_server(tmp_path):
+    # Serves three small PDFs, two of them with the same content
+    www = tmp_path / 'www'
+    www.mkdir()
+    for name, content in [('r0.pdf', b'%PDF-zero'), ('r1.pdf', b'%PDF-one'), ('copy.pdf', b'%PDF-one')]:
+        (www / name).write_bytes(content)
+    handler = functools.partial(SimpleHTTPRequestHandler, directory=str(www))
+    handler.log_message = lambda *args: None
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f'http://127.0.0.1:{server.server_port}'
+    server.shutdown()
+
+@pytest.fixture
+def local_db(tmp_path, monkeypatch):
+    monkeypatch.setenv('LOCAL_DB_MODE', 'True')
+    monkeypatch.setenv('LOCAL_DB_ENGINE', 'sqlite')
+    monkeypatch.setenv('LOCAL_DB_NAME', str(tmp_path / 'test.db'))
+    from db_classes import Base
+    engine = create_engine(f"sqlite:///{tmp_path / 'test.db'}")
+    Base.metadata.create_all(engine)
+    engine.dispose()
+
+def test_cas_run_twice_keeps_the_stored_names(tmp_path, pdf_server, local_db):
+    from db_download_manager import DownloadManager
+    from db_classes import GRIPdf
+    sheet = tmp_path / 'urls.csv'
+    sheet.write_text('BRnum,Pdf_URL,Report Html Address\n'
+                     f'BR0,{pdf_server}/r0.pdf,\n'
+                     f'BR1,{pdf_server}/r1.pdf,\n'
+                     f'BR2,{pdf_server}/copy.pdf,\n')
+    stored = None
+    for run in range(2):
+        dm = DownloadManager(folder=str(tmp_path / 'pdf-files'), file_with_urls=str(sheet))
+        for counters in dm.start_download(0, 3, storage='cas'):
+            pass
+        with dm.SessionLocal() as session:
+            rows = {pdf.brnumber: (pdf.file_folder, pdf.file_name) for pdf in session.query(GRIPdf)}
+        for file_folder, file_name in rows.values():
+            assert os.path.exists(f'{file_folder}/{file_name}')
+            assert file_name.endswith('.pdf') and len(file_name) == len('.pdf') + 64
+        if stored is None:
+            stored = rows
+        # A second run over the same sheet leaves every row on the file it was stored under
+        assert rows == stored
+    assert rows['BR1'] == rows['BR2']
@@ -0,0 +1,78 @@
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import urllib.request
+import urllib.error
+import threading
+import pytest
+from db_http_connections import KeepAliveHandler
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    connections = 0
+
+    def setup(self):
+        super().setup()
+        Handler.connections += 1
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        if self.path == '/missing':
+            self.send_response(404)
+            self.send_header('Content-Length', '9')
+            self.end_headers()
+            self.wfile.write(b'not found')
+            return
+        if self.path == '/moved':
+            self.send_response(302)
+            self.send_header('Location', '/file')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        body = b'%PDF-' + self.path.encode() * 1000
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        # Drops the connection like an idle timeout, without a Connection: close header
+        if self.path == '/dropped':
+            self.close_connection = True
+
+@pytest.fixture
+def server():
+    Handler.connections = 0
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f'http://127.0.0.1:{server.server_port}'
+    server.shutdown()
+
+def test_requests_to_a_host_share_a_connection(server):
+    handler = KeepAliveHandler()
+    opener = urllib.request.build_opener(handler)
+    for path in ['/a', '/b', '/moved', '/c']:
+        with opener.open(f'{server}{path}', timeout=5) as response:
+            assert response.read().startswith(b'%PDF-')
+    with pytest.raises(urllib.error.HTTPError):
+        opener.open(f'{server}/missing', timeout=5)
+    assert Handler.connections == 1
+    handler.close_all()
+
+def test_a_response_left_unread_gets_a_new_connection(server):
+    handler = KeepAliveHandler()
+    opener = urllib.request.build_opener(handler)
+    with opener.open(f'{server}/a', timeout=5) as response:
+        assert response.read(5) == b'%PDF-'
+    with opener.open(f'{server}/b', timeout=5) as response:
+        assert response.read() == b'%PDF-' + b'/b' * 1000
+    assert Handler.connections == 2
+    handler.close_all()
+
+def test_a_connection_closed_by_the_server_is_replaced(server):
+    handler = KeepAliveHandler()
+    opener = urllib.request.build_opener(handler)
+    with opener.open(f'{server}/dropped', timeout=5) as response:
+        response.read()
+    with opener.open(f'{server}/b', timeout=5) as response:
+        assert response.read().startswith(b'%PDF-/b')
+    assert Handler.connections == 2
+    handler.close_all()
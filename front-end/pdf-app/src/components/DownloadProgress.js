@@ -4,6 +4,15 @@ import { AuthContext } from '../contexts/auth.js';
 import { useNavigate } from 'react-router-dom';
 import { Card, ProgressBar } from 'react-bootstrap';
 
+// Statuses after which a task's results don't change anymore
+const FINAL_STATUSES = ['finished', 'cancelled', 'failed'];
+const STATUS_VARIANTS = {
+    queued: 'info',
+    running: 'warning',
+    finished: 'success',
+    cancelled: 'secondary',
+    failed: 'danger'
+};
 
 function DownloadProgress({ taskId }) {
     const navigate = useNavigate();
@@ -13,47 +22,116 @@ function DownloadProgress({ taskId }) {
 
 
     useEffect(() => {
+        if (!taskId) {
+            return undefined;
+        }
         let interval = null;
+        let eventSource = null;
+        let stopped = false;
+
+        const showProgress = (data) => {
+            const { num_rows, processed_rows, results, status, start_time, running_time, start_row, running_file } = data;
+            const progress = (processed_rows / num_rows) * 100;
+            setDownloadProgress({
+                taskId,
+                progress,
+                results,
+                status,
+                start_time,
+                running_time,
+                start_row,
+                num_rows,
+                processed_rows,
+                running_file
+            });
+        };
 
-        if (taskId && (!downloadProgress || downloadProgress.status !== 'finished')) {
+        const fetchResults = () => api.get(`/download_results/${taskId}`, {
+            headers: {
+                'Authorization': `Bearer ${userToken}`,
+            },
+        })
+            .then(response => {
+                if (!stopped && response.data.status) {
+                    showProgress(response.data);
+                }
+                return response.data.status;
+            });
+
+        // Polls the results every second until the task is done, used when the event stream isn't available
+        const startPolling = () => {
+            if (stopped || interval) {
+                return;
+            }
             interval = setInterval(() => {
-                api.get(`/download_results/${taskId}`, {
-                    headers: {
-                        'Authorization': `Bearer ${userToken}`,
-                    },
-                })
-                    .then(response => {
-                        const { num_rows, processed_rows, results, status, start_time, running_time, start_row, running_file } = response.data;
-                        const progress = (processed_rows / num_rows) * 100;
-                        setDownloadProgress({
-                            taskId,
-                            progress,
-                            results,
-                            status,
-                            start_time,
-                            running_time,
-                            start_row,
-                            num_rows,
-                            processed_rows,
-                            running_file
-                        });
+                fetchResults()
+                    .then(status => {
+                        if (FINAL_STATUSES.includes(status) && interval) {
+                            clearInterval(interval);
+                            interval = null;
+                        }
                     })
                     .catch(error => {
                         console.error('Error fetching download results:', error);
                     });
             }, 1000);
+        };
+
+        if (typeof EventSource === 'undefined') {
+            startPolling();
+        } else {
+            // EventSource can't send the Authorization header, the token goes in the query string
+            eventSource = new EventSource(`${api.defaults.baseURL}/download_results/${taskId}/stream?access_token=${encodeURIComponent(userToken)}`);
+            eventSource.addEventListener('snapshot', (event) => {
+                showProgress(JSON.parse(event.data));
+            });
+            eventSource.addEventListener('progress', (event) => {
+                const delta = JSON.parse(event.data);
+                setDownloadProgress(current => {
+                    if (!current) {
+                        return current;
+                    }
+                    const processed_rows = delta.processed_rows !== undefined ? delta.processed_rows : current.processed_rows;
+                    // Counters only move once a queued task runs, the stream doesn't send that change by itself
+                    return {
+                        ...current,
+                        status: current.status === 'queued' ? 'running' : current.status,
+                        results: { ...current.results, ...delta },
+                        processed_rows,
+                        progress: (processed_rows / current.num_rows) * 100
+                    };
+                });
+            });
+            FINAL_STATUSES.forEach(status => {
+                eventSource.addEventListener(status, () => {
+                    // The stream ends with the status, the final counters and running time come from the results
+                    eventSource.close();
+                    fetchResults().catch(error => {
+                        console.error('Error fetching download results:', error);
+                    });
+                });
+            });
+            // A task that isn't running (anymore) or a broken stream falls back to polling
+            eventSource.onerror = () => {
+                eventSource.close();
+                startPolling();
+            };
         }
 
         return () => {
+            stopped = true;
+            if (eventSource) {
+                eventSource.close();
+            }
             if (interval) {
                 clearInterval(interval);
             }
         };
-    }, [taskId, downloadProgress]);
+    }, [taskId, userToken]);
 
 
     useEffect(() => {
-        if (downloadProgress && downloadProgress.status === 'finished') {
+        if (downloadProgress && FINAL_STATUSES.includes(downloadProgress.status)) {
             let elapsedSeconds;
             const taskKey = `finalElapsedTime_${downloadProgress.taskId}`; // Modify this line
             const storedTime = localStorage.getItem(taskKey); // Modify this line
@@ -81,7 +159,7 @@ function DownloadProgress({ taskId }) {
                             <ProgressBar
                                 now={downloadProgress.progress}
                                 label={`${downloadProgress.progress.toFixed(2)}%`}
-                                variant={downloadProgress.status === 'running' ? 'warning' : 'success'}
+                                variant={STATUS_VARIANTS[downloadProgress.status] || 'warning'}
                                 style={{
                                     height: '30px', // Increase the thickness of the progress bar
                                     fontSize: '18px', // Increase the font size of the label
@@ -98,7 +176,7 @@ function DownloadProgress({ taskId }) {
                             {downloadProgress.progress && <ProgressBar
                                 now={downloadProgress.progress}
                                 label={`${downloadProgress.progress.toFixed(2)}%`}
-                                variant={downloadProgress.status === 'running' ? 'warning' : 'success'}
+                                variant={STATUS_VARIANTS[downloadProgress.status] || 'warning'}
                                 style={{
                                     height: '30px', // Increase the thickness of the progress bar
                                     fontSize: '18px', // Increase the font size of the label
@@ -137,7 +215,7 @@ function DownloadProgress({ taskId }) {
                                             <tr>
                                                 <td>Elapsed time:</td>
                                                 <td>
-                                                    {downloadProgress.status !== 'finished' ? (
+                                                    {!FINAL_STATUSES.includes(downloadProgress.status) ? (
                                                         (() => {
                                                             const elapsedSeconds = Math.floor((new Date() - new Date(downloadProgress.start_time)) / 1000) + downloadProgress.running_time;
                                                             const hours = Math.floor(elapsedSeconds / 3600);
@@ -146,7 +224,7 @@ function DownloadProgress({ taskId }) {
                                                             return `${hours} hours, ${minutes} minutes, ${seconds} seconds`;
                                                         })()
                                                     ) : (
-                                                        // Display the final elapsed time when the status is 'finished'
+                                                        // Display the final elapsed time once the task is finished, cancelled or failed
                                                         finalElapsedTime
                                                     )}
                                                 </td>
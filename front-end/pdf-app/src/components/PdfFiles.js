@@ -7,6 +7,10 @@ import Toast from 'react-bootstrap/Toast';
 import Pagination from 'react-bootstrap/Pagination';
 import { Card, Button, Form, InputGroup, FormControl, DropdownButton, Dropdown, Row, Col } from 'react-bootstrap';
 
+// Indexed fields the API can filter and sort on, the same as GRIPdf.QUERY_FIELDS
+const QUERY_FIELDS = ['brnumber', 'publication_year', 'organization_name', 'organization_type', 'organization_sector',
+    'country', 'region', 'download_status', 'download_attempt_date'];
+
 const PdfFiles = () => {
     const navigate = useNavigate();
     const { userToken, handleContextLogin, isAdmin, setuserToken } = useContext(AuthContext);
@@ -145,7 +149,7 @@ const PdfFiles = () => {
                     <div className="d-flex justify-content-between">
                         <DropdownButton id="dropdown-basic-button" title={selectedFilterKey || "Select filter"} className="mr-2">
                             {pdfFiles.length > 0 && Object.keys(pdfFiles[0])
-                                .filter(key => key !== 'pdf_url' && key !== 'pdf_backup_url' && key !== 'file_name')
+                                .filter(key => QUERY_FIELDS.includes(key))
                                 .map(key => (
                                     <Dropdown.Item key={key} onClick={() => setSelectedFilterKey(key)}>
                                         {key}
@@ -196,6 +200,7 @@ const PdfFiles = () => {
                                                 style={{ width: '100%' }}
                                                 className="btn btn-outline-primary text-left text-nowrap"
                                                 onClick={() => handleSort(key)}
+                                                disabled={!QUERY_FIELDS.includes(key)}
                                             >
                                                 {key.charAt(0).toUpperCase() + key.slice(1)} {sortColumn === key && (sortDirection ? '↓' : '↑')}
                                             </button>